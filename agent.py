@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from contextlib import closing
+from json import dumps, loads
+from os import chdir, getcwd, remove, umask
+from os.path import exists
+from SocketServer import StreamRequestHandler, UnixStreamServer
+import socket
+import sys
+from threading import Lock, Thread
+from time import sleep, time
+from traceback import print_exc
+
+# Import from itools
+from itools.log import log_info
+
+# Import from usine
+from hosts import RemoteHost, remote_hosts
+from utils import output
+
+
+"""
+The usine agent is a long running process that keeps the connections to the
+remote hosts open.  The command line sends it the commands to run through a
+Unix socket, so successive commands do not pay for the SSH handshakes.
+
+The protocol: the client sends a JSON line {"argv": [...], "cwd": "..."}, the
+agent answers with frames "O<size>\\n<data>" (stdout), "E<size>\\n<data>"
+(stderr), and ends with "X<status>\\n".
+"""
+
+
+class AgentWriter(object):
+    """File-like object sending what is written to the client.
+    """
+
+    def __init__(self, wfile, stream):
+        self.wfile = wfile
+        self.stream = stream
+        self.lock = Lock()
+
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self.lock:
+            self.wfile.write('%s%d\n%s' % (self.stream, len(data), data))
+
+
+    def flush(self):
+        self.wfile.flush()
+
+
+
+class AgentHandler(StreamRequestHandler):
+
+    def handle(self):
+        request = loads(self.rfile.readline())
+        agent = self.server
+        with agent.lock:
+            agent.last_request = time()
+            stdout, stderr, cwd = sys.stdout, sys.stderr, getcwd()
+            sys.stdout = AgentWriter(self.wfile, 'O')
+            sys.stderr = AgentWriter(self.wfile, 'E')
+            try:
+                chdir(request['cwd'])
+                agent.command([ x.encode('utf-8') for x in request['argv'] ])
+            except SystemExit as e:
+                status = e.code
+            except Exception:
+                print_exc()
+                status = 1
+            else:
+                status = 0
+            finally:
+                # The output is written in the background
+                output.flush()
+                sys.stdout, sys.stderr = stdout, stderr
+                chdir(cwd)
+                agent.last_request = time()
+
+        # Exit status, like sys.exit
+        if status is None:
+            status = 0
+        elif type(status) is not int:
+            AgentWriter(self.wfile, 'E').write('%s\n' % status)
+            status = 1
+        self.wfile.write('X%d\n' % status)
+
+
+
+class UsineAgent(UnixStreamServer):
+    """Run the commands sent to the given socket with the given function,
+    one at a time.  The connections to the remote hosts are kept alive, and
+    closed after 'host_timeout' seconds without use.  The agent stops after
+    'timeout' seconds without commands.
+    """
+
+    def __init__(self, path, command, timeout=3600, host_timeout=600,
+                 keepalive=30):
+        if exists(path):
+            remove(path)
+        # Only the user may connect, from the moment the socket exists
+        old_umask = umask(0077)
+        try:
+            UnixStreamServer.__init__(self, path, AgentHandler)
+        finally:
+            umask(old_umask)
+        self.path = path
+        self.command = command
+        self.idle_timeout = timeout
+        self.host_timeout = host_timeout
+        self.lock = Lock()
+        self.last_request = time()
+        # Keep the connections alive
+        RemoteHost.keepalive = keepalive
+
+
+    def close_idle_hosts(self):
+        while True:
+            sleep(30)
+            with self.lock:
+                for host in remote_hosts.values():
+                    if host.ssh and time() - host.last_used > self.host_timeout:
+                        log_info('Close idle connection to %s' % host.host)
+                        host.close()
+                idle = time() - self.last_request > self.idle_timeout
+            if idle:
+                log_info('Agent idle, stopping')
+                self.shutdown()
+                return
+
+
+    def serve(self):
+        log_info('Agent listening on %s' % self.path)
+        thread = Thread(target=self.close_idle_hosts)
+        thread.daemon = True
+        thread.start()
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            remove(self.path)
+            for host in remote_hosts.values():
+                host.close()
+
+
+
+def call_agent(path, argv):
+    """Run the given command line in the agent listening on the given
+    socket.  Return the exit status, or None if the agent is not running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return None
+
+    with closing(sock), closing(sock.makefile('rwb', 0)) as channel:
+        channel.write(dumps({'argv': argv, 'cwd': getcwd()}) + '\n')
+        while True:
+            header = channel.readline()
+            if not header:
+                # The agent died
+                return 1
+            stream, value = header[0], int(header[1:])
+            if stream == 'X':
+                return value
+            data = channel.read(value)
+            output = sys.stdout if stream == 'O' else sys.stderr
+            output.write(data)
+            output.flush()
@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from errno import EEXIST
+from hashlib import sha1
+from json import dump, load
+from os import getpid, listdir, makedirs, rename, utime
+from os.path import basename, exists, expanduser, getmtime, getsize, join
+from shutil import copyfile, rmtree
+from threading import Lock
+
+# Import from itools
+from itools.log import log_info
+
+
+"""
+A local cache of build artifacts, like source distributions.  Artifacts are
+stored by key, a hash of everything the build depends on (the commit, the
+Python version, ...), so an artifact is never stale.  The cache is bounded
+in size, the least recently used artifacts are removed first.
+"""
+
+
+def get_key(*inputs):
+    """Return the cache key for the given build inputs (strings).
+    """
+    return sha1('\0'.join(inputs)).hexdigest()
+
+
+
+class ArtifactCache(object):
+
+    def __init__(self, path, max_size):
+        self.path = expanduser(path)
+        self.max_size = max_size
+        self.lock = Lock()
+
+
+    def get(self, key):
+        """Return the path to the artifact stored with the given key, or
+        None if there is not any.
+        """
+        folder = join(self.path, key)
+        if not exists(folder):
+            return None
+
+        names = listdir(folder)
+        if len(names) != 1:
+            return None
+        # Keep track of the last use
+        utime(folder, None)
+        return join(folder, names[0])
+
+
+    def put(self, key, source):
+        """Copy the given file to the cache, return the path to the copy.
+        """
+        folder = join(self.path, key)
+        target = join(folder, basename(source))
+        with self.lock:
+            if not exists(folder):
+                # Write to a temporary folder first, so an interrupted copy
+                # is never taken for an artifact
+                tmp = '%s.tmp' % folder
+                if exists(tmp):
+                    rmtree(tmp)
+                makedirs(tmp)
+                copyfile(source, join(tmp, basename(source)))
+                rename(tmp, folder)
+            self.evict()
+        return target
+
+
+    def evict(self):
+        """Remove the least recently used artifacts until the size of the
+        cache is below the limit.
+        """
+        entries = []
+        total = 0
+        for key in listdir(self.path):
+            if key.endswith('.tmp'):
+                continue
+            folder = join(self.path, key)
+            size = sum([ getsize(join(folder, x)) for x in listdir(folder) ])
+            entries.append((getmtime(folder), size, folder))
+            total += size
+
+        entries.sort()
+        while entries and total > self.max_size:
+            mtime, size, folder = entries.pop(0)
+            log_info('[CACHE] Evict %s' % folder)
+            rmtree(folder)
+            total -= size
+
+
+
+class MetadataCache(object):
+    """Small JSON documents stored on disk by key, and kept in memory once
+    read.
+    """
+
+    def __init__(self, path):
+        self.path = expanduser(path)
+        self.cache = {}
+        self.lock = Lock()
+
+
+    def get(self, key):
+        data = self.cache.get(key)
+        if data is None:
+            path = join(self.path, '%s.json' % key)
+            if not exists(path):
+                return None
+            with open(path) as file:
+                data = load(file)
+            self.cache[key] = data
+        return data
+
+
+    def put(self, key, data):
+        # The temporary file is per process, and the threads write in turn
+        with self.lock:
+            try:
+                makedirs(self.path)
+            except OSError as error:
+                if error.errno != EEXIST:
+                    raise
+            path = join(self.path, '%s.json' % key)
+            tmp = '%s.%s.tmp' % (path, getpid())
+            with open(tmp, 'w') as file:
+                dump(data, file)
+            rename(tmp, path)
+            self.cache[key] = data
+
+
+
+# Source distributions and wheels
+sdist_cache = ArtifactCache('~/.usine/cache/.sdist', 1024 * 1024 * 1024)
+wheel_cache = ArtifactCache('~/.usine/cache/.wheel', 1024 * 1024 * 1024)
+# Package metadata
+metadata_cache = MetadataCache('~/.usine/cache/.metadata')
+# The duration of the deploy tasks, by pyenv, to estimate the next ones
+durations_cache = MetadataCache('~/.usine/cache/.durations')
+# The vhosts of the ikaaro instances of the whole fleet
+vhosts_index = MetadataCache('~/.usine/cache/.vhosts-index')
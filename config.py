@@ -16,12 +16,15 @@
 
 # Import from the Standard Library
 from ConfigParser import RawConfigParser
-from os.path import expanduser
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from fnmatch import fnmatchcase
+from os import getpid, listdir, makedirs, remove, rename, stat
+from os.path import dirname, exists, expanduser, isfile
+from threading import Lock
 
 # Import from itools
 from itools.core import freeze
 from itools.log import log_info, log_fatal
-from itools.fs import lfs
 
 # Import from usine
 from hosts import local
@@ -30,50 +33,167 @@ from libusine.utils import logWrapper
 
 
 
+snapshot_path = expanduser('~/.usine/cache/.config.pickle')
+completion_paths = {
+    False: expanduser('~/.usine/cache/.completion'),
+    True: expanduser('~/.usine/cache/.completion-offline')}
+
+
+def get_signature(paths):
+    """Return the modification time and size of the given files, to know
+    whether they changed.
+    """
+    signature = []
+    for path in sorted(paths):
+        info = stat(path)
+        signature.append((path, info.st_mtime, info.st_size))
+    return signature
+
+
+
+def read_snapshot(signature):
+    """Return the sections and the index saved in the snapshot, or None if
+    there is no snapshot or if the INI files changed since.
+    """
+    if not exists(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, 'rb') as file:
+            snapshot = load(file)
+    except Exception:
+        return None
+    if snapshot['signature'] != signature or 'index' not in snapshot:
+        return None
+    return snapshot['sections'], snapshot['index']
+
+
+
+def write_snapshot(signature, sections, index):
+    folder = dirname(snapshot_path)
+    if not exists(folder):
+        makedirs(folder)
+    tmp = '%s.%s.tmp' % (snapshot_path, getpid())
+    with open(tmp, 'wb') as file:
+        snapshot = {'signature': signature, 'sections': sections,
+                    'index': index}
+        dump(snapshot, file, HIGHEST_PROTOCOL)
+    rename(tmp, snapshot_path)
+
+
+
+def get_references(type, options):
+    """Return the sections, as (type, name), the given section refers to.
+    """
+    if type == 'ikaaro':
+        return [('pyenv', options['pyenv'])]
+    elif type == 'pyenv':
+        location = options['location']
+        if location[:10] == 'localhost:':
+            server = 'localhost'
+        else:
+            server = location.split('@', 1)[-1].split(':', 1)[0]
+        references = [('server', server)]
+        for package in options.get('packages', '').split():
+            references.append(('pysrc', package.split(':')[0]))
+        return references
+    elif type == 'pysrc' and 'mirror' in options:
+        return [('mirror', options['mirror'])]
+    return []
+
+
+
+def build_index(sections):
+    """Return the names of the sections of every type, sorted, and the
+    reverse references: (type, ref_type, ref_name) -> [name, ...]
+    """
+    index = {}
+    for section in sorted(sections):
+        type, name = section.split()
+        index.setdefault(type, []).append(name)
+        for reference in get_references(type, sections[section]):
+            key = (type,) + reference
+            index.setdefault(key, []).append(name)
+    return index
+
+
+
 class configuration(object):
 
     class_title = u'Manage configuration'
     class_actions = freeze([''])
 
     def __init__(self):
-        self.by_type = {}            # type: [<data>, ..]
-        self.by_type_and_name = {}   # (type, name): <data>
+        self.sections = {}           # '<type> <name>': <options>
+        self.index = {}              # see build_index
+        self.objects = {}            # (type, name): <module>
+        self.lock = Lock()
 
     def load(self):
+        # Start from scratch, the agent loads the configuration every time
+        self.objects = {}
         path = expanduser('~/.usine')
-        if lfs.is_file(path):
+        if isfile(path):
             log_fatal('ERROR: %s is a file, remove it first' % path)
 
         # Make the user configuration file if needed
-        if not lfs.exists(path):
+        if not exists(path):
             log_info('Making the configuration folder: {}'.format(path))
-            lfs.make_folder(path)
+            makedirs(path)
             log_fatal('Now add the INI files within the folder')
 
         # Read the user configuration file
         ini = [ '%s/%s' % (path, x)
-                for x in lfs.get_names(path) if x[-4:] == '.ini' ]
+                for x in listdir(path) if x[-4:] == '.ini' ]
         if len(ini) == 0:
             log_fatal('ERROR: zero INI files found in {}/'.format(path))
 
-        # Read the ini file
-        cfg = RawConfigParser()
-        cfg.read(ini)
+        # Read the snapshot, or the INI files if they changed
+        signature = get_signature(ini)
+        snapshot = read_snapshot(signature)
+        if snapshot is None:
+            cfg = RawConfigParser()
+            cfg.read(ini)
+            sections = dict([ (x, dict(y)) for x, y in cfg._sections.items() ])
+            index = build_index(sections)
+            write_snapshot(signature, sections, index)
+        else:
+            sections, index = snapshot
 
-        # Get the data
-        for section in cfg._sections:
-            options = cfg._sections[section]
-            type, name = section.split()
-            module = modules[type]
-            obj = module(options)
+        # The module objects are made on demand, see get_section
+        self.sections = sections
+        self.index = index
 
-            # Keep the data unit
-            self.by_type.setdefault(type, []).append(obj)
-            self.by_type_and_name[(type, name)] = obj
+        # The index read by the shell completion, one per value of
+        # --offline since the actions depend on it
+        offline = bool(self.options.offline)
+        if snapshot is None:
+            for path in completion_paths.values():
+                if exists(path):
+                    remove(path)
+        if not exists(completion_paths[offline]):
+            self.write_completion_index(completion_paths[offline])
 
-        # Sort
-        for type in self.by_type:
-            self.by_type[type].sort(key=lambda x: x.name)
+
+    def write_completion_index(self, path):
+        """Write the modules, their items and the actions of every item to
+        the given file, read by contrib/usine_completion:
+
+          module <module>
+          item <module> <item> <action> ...
+        """
+        lines = []
+        for type in sorted(modules):
+            if not modules[type].class_title:
+                continue
+            lines.append('module %s\n' % type)
+            for item in self.get_sections_by_type(type):
+                actions = ' '.join(item.get_actions())
+                lines.append('item %s %s %s\n' % (type, item.name, actions))
+
+        tmp = '%s.%s.tmp' % (path, getpid())
+        with open(tmp, 'w') as file:
+            file.write(''.join(lines))
+        rename(tmp, path)
 
 
     update_title = u'Update usine configuration'
@@ -83,20 +203,81 @@ class configuration(object):
         If config folder is a GIT repository, rebase it
         """
         path = expanduser('~/.usine')
-        for x in lfs.get_names(path):
+        for x in listdir(path):
             folder = '{}/{}'.format(path, x)
-            if lfs.exists('{}/.git'.format(folder)):
+            if exists('{}/.git'.format(folder)):
                 local.run(['git', 'fetch', 'origin'], cwd=folder)
                 local.run(['git', 'reset', '--hard', 'origin/master'], cwd=folder)
 
+        # Rebuild the snapshot
+        if exists(snapshot_path):
+            remove(snapshot_path)
+        self.load()
+
+
+    def get_section_names(self, type):
+        return self.index.get(type, [])
+
 
     def get_sections_by_type(self, type):
-        return self.by_type.get(type, [])
+        names = self.get_section_names(type)
+        return [ self.get_section(type, x) for x in names ]
 
 
     def get_section(self, type, name):
         key = (type, name)
-        return self.by_type_and_name.get(key)
+        obj = self.objects.get(key)
+        if obj is None:
+            options = self.sections.get('%s %s' % key)
+            if options is None:
+                return None
+            with self.lock:
+                obj = self.objects.get(key)
+                if obj is None:
+                    obj = modules[type](options)
+                    self.objects[key] = obj
+        return obj
+
+
+    def get_sections_by_reference(self, type, ref_type, ref_name):
+        """Return the sections of the given type referring to the section
+        (ref_type, ref_name), for instance the ikaaro instances of a pyenv
+        with ('ikaaro', 'pyenv', <name>).
+        """
+        names = self.index.get((type, ref_type, ref_name), [])
+        return [ self.get_section(type, x) for x in names ]
+
+
+    def select_sections(self, type, selector):
+        """Return the sections of the given type matching the selector, a
+        comma separated list of:
+
+        - names or glob patterns, like 'prod-*'
+        - 'all', for every section of the type
+        - 'group:<name>', for the sections listing <name> in their 'groups'
+          option
+        """
+        names = self.get_section_names(type)
+        selected = []
+        for token in selector.split(','):
+            token = token.strip()
+            if token == 'all':
+                matches = names
+            elif token.startswith('group:'):
+                group = token[6:]
+                matches = [
+                    x for x in names
+                    if group in self.sections['%s %s' % (type, x)].get(
+                        'groups', '').split() ]
+            else:
+                matches = [ x for x in names if fnmatchcase(x, token) ]
+            # Keep the order, without duplicates
+            for name in matches:
+                if name not in selected:
+                    selected.append(name)
+
+        return [ self.get_section(type, x) for x in selected ]
+
 
 
 # singleton
@@ -15,40 +15,197 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from contextlib import closing
+from contextlib import closing, contextmanager
 from getpass import getpass
-from os.path import basename, expanduser
-import socket
+from hashlib import sha1
+from os import rename
+from os.path import basename, exists, expanduser, getsize
+from re import compile as compile_regex
+from select import select
 from stat import S_ISDIR
-from sys import stdout
-
-# Import from paramiko
-from paramiko import AutoAddPolicy, SSHClient, PasswordRequiredException
-
-# Add log
-import paramiko
-paramiko.util.log_to_file(expanduser("~/.usine/paramiko.log"))
+from subprocess import Popen, PIPE
+from tempfile import SpooledTemporaryFile
+from threading import Lock, Thread
+from time import time
+from uuid import uuid4
 
 # Import from itools
-from itools.core import get_pipe
-from itools.log import log_info
+from itools.log import log_info, log_error
+
+# Import from usine
+from utils import end_output, format_size, log_prefix, run_parallel, span
+from utils import write_output
 
 
 """
 This module provides a common interface to access the localhost and to
 access a remote host (through paramiko).  The common API is:
 
-- run: to execute a command
+- run: to execute a command, returns a CommandResult, raises CommandError
+  if it fails (unless 'check' is false)
+
+- capture: to execute a command without printing anything, returns its
+  CommandResult whatever the status
 
 - put: to copy a file
+
+- read_file, write_file: to read and write small files
+
+Paramiko is only imported when the first connection is made, so commands
+that do not connect (help, completion, local actions) start faster.
 """
 
 
 
+###########################################################################
+# Common API
+###########################################################################
+class CommandOutput(object):
+    """The output of a command (stdout or stderr).  It is kept in memory up
+    to 'max_memory' bytes, and in a temporary file past that, so long
+    outputs use constant memory.  The last 'tail_size' bytes are always in
+    memory, for the error reports.
+    """
+
+    def __init__(self, max_memory=1024 * 1024, tail_size=8192):
+        self.file = SpooledTemporaryFile(max_memory)
+        self.size = 0
+        self.tail_size = tail_size
+        self.tail = ''
+
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.tail = (self.tail + data)[-self.tail_size:]
+
+
+    def read(self):
+        """Return the whole output.
+        """
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0, 2)
+        return data
+
+
+    def get_tail(self, lines=20):
+        """Return the last lines of the output.
+        """
+        return '\n'.join(self.tail.splitlines()[-lines:])
+
+
+    def close(self):
+        self.file.close()
+
+
+
+class CommandResult(object):
+    """The exit status, the duration and the output of a command.
+    """
+
+    def __init__(self, command, host, cwd):
+        self.command = command
+        self.host = host
+        self.cwd = cwd
+        self.status = None
+        self.start = time()
+        self.duration = None
+        self.stdout = CommandOutput()
+        self.stderr = CommandOutput()
+
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time() - self.start
+
+
+    @property
+    def output(self):
+        """The whole standard output.
+        """
+        return self.stdout.read()
+
+
+    def get_error(self):
+        """Return a message describing the failure, with the end of the
+        output.
+        """
+        tail = self.stderr.get_tail() or self.stdout.get_tail()
+        message = '%s: "%s" exited with status %s' % (self.host, self.command,
+                                                       self.status)
+        if tail:
+            message = '%s\n%s' % (message, tail)
+        return message
+
+
+    def check(self):
+        """Raise CommandError if the command failed, return the result
+        otherwise.
+        """
+        if self.status:
+            raise CommandError(self)
+        return self
+
+
+
+class CommandError(EnvironmentError):
+    """Raised when a command fails, 'result' is its CommandResult.
+    """
+
+    def __init__(self, result):
+        EnvironmentError.__init__(self, result.get_error())
+        self.result = result
+
+
+
+class Host(object):
+
+    def run_concurrent(self, commands, limit=4):
+        """Run several commands at the same time, at most 'limit' at once.
+        'commands' is a list of (name, cwd, command) tuples, where command
+        is a string or a list of strings to run one after the other, until
+        one fails; the output is prefixed by the name.  Return the exit
+        statuses, the one of the failed command if any.
+
+        On a remote host every command runs over its own channel of the
+        same connection (in shell mode they wait for the shell session).
+        """
+        def run(task):
+            name, cwd, command = task
+            if type(command) is str:
+                command = [command]
+            with log_prefix(name), span(name):
+                for x in command:
+                    status = self.run(x, cwd, check=False).status
+                    if status:
+                        break
+            return status
+
+        statuses = []
+        for (name, cwd, command), status, error in run_parallel(run, commands,
+                                                                limit):
+            if error:
+                log_error('[ERROR] %s: %s' % (name, error))
+                status = 1
+            statuses.append(status)
+        return statuses
+
+
+
 ###########################################################################
 # Local host
 ###########################################################################
-class LocalHost(object):
+def read_pipe(pipe, output):
+    data = pipe.read(32768)
+    while data:
+        output.write(data)
+        data = pipe.read(32768)
+    pipe.close()
+
+
+
+class LocalHost(Host):
 
     cwd = None
 
@@ -57,10 +214,10 @@ class LocalHost(object):
         self.cwd = expanduser(cwd)
 
 
-    def run(self, command, cwd=None):
-        # Change dir
-        if cwd:
-            self.chdir(cwd)
+    def run(self, command, cwd=None, quiet=False, check=True):
+        # The working directory is per call, so concurrent tasks sharing
+        # this host do not change each other's
+        cwd = expanduser(cwd) if cwd else self.cwd
         # Format command
         if type(command) is str:
             command = expanduser(command)
@@ -69,81 +226,186 @@ class LocalHost(object):
         else:
             command_str = ' '.join(command)
         # Print
-        log_info('%s $ %s' % (self.cwd, command_str))
+        if quiet is False:
+            log_info('%s $ %s' % (cwd, command_str))
         # Call
-        return get_pipe(command, cwd=self.cwd)
+        with span(command_str, host='localhost', cwd=cwd) as tags:
+            result = CommandResult(command_str, 'localhost', cwd)
+            process = Popen(command, cwd=cwd, stdout=PIPE, stderr=PIPE)
+            # Read both pipes, so the command never waits on a full one
+            stderr = Thread(target=read_pipe,
+                            args=(process.stderr, result.stderr))
+            stderr.start()
+            read_pipe(process.stdout, result.stdout)
+            stderr.join()
+            result.finish(process.wait())
+            tags['status'] = result.status
+
+        if check:
+            result.check()
+        return result
+
+
+    def capture(self, command, cwd=None):
+        """Run the command and return its CommandResult, without printing
+        anything.
+        """
+        return self.run(command, cwd, quiet=True, check=False)
 
 
     def put(self, source, target):
         raise NotImplementedError
 
 
+    def read_file(self, path):
+        """Return the content of the file, or None if it does not exist.
+        """
+        path = expanduser(path)
+        if not exists(path):
+            return None
+        with open(path) as file:
+            return file.read()
+
+
+    def write_file(self, path, data):
+        path = expanduser(path)
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as file:
+            file.write(data)
+        rename(tmp, path)
+
+
 
 ###########################################################################
 # Remote host
 ###########################################################################
-def read_from_channel(recv):
-    buffer = []
-    try:
-        data = recv(1024)
+def get_checksum(path):
+    """Return the size and the SHA-1 of the given local file.
+    """
+    checksum = sha1()
+    with open(path, 'rb') as file:
+        data = file.read(65536)
         while data:
-            buffer.append(data)
-            data = recv(1024)
-    except socket.timeout:
-        pass
+            checksum.update(data)
+            data = file.read(65536)
+    return getsize(path), checksum.hexdigest()
 
-    return ''.join(buffer)
 
 
+class ShellSession(object):
+    """A long-lived interactive shell, for the hosts where the commands
+    cannot be executed directly.  The commands run one after the other in
+    the same shell, every command ends by printing a unique sentinel with
+    its exit status.
+    """
 
-def run_with_shell(channel, cwd, command):
-    command = 'cd %s\n%s\necho EOF\n' % (cwd, command)
+    def __init__(self, transport):
+        self.channel = transport.open_session()
+        self.channel.get_pty()
+        self.channel.invoke_shell()
+        # No echo and no prompt, skip the banner
+        init = "stty -echo; PS1=''; PS2=''; unset PROMPT_COMMAND"
+        self.run('~', init, lambda data: None)
 
-    # Call
-    channel.invoke_shell()
-    channel.settimeout(0.0)
-    channel.send(command)
-    while True:
-        data = read_from_channel(channel.recv)
-        # Check EOF
-        if not data or data.endswith('EOF\n'):
-            data = data[:-4]
-            stdout.write(data)
-            stdout.flush()
-            break
-        stdout.write(data)
-        stdout.flush()
-    # Error
-    data = read_from_channel(channel.recv_stderr)
-    if data:
-        stdout.write(data)
-        stdout.flush()
 
+    @property
+    def closed(self):
+        return self.channel.closed
 
 
-def run_without_shell(channel, cwd, command):
+    def close(self):
+        self.channel.close()
+
+
+    def run(self, cwd, command, write):
+        """Run the command, pass its output to 'write' as it comes, and
+        return its exit status.
+        """
+        token = uuid4().hex
+        # The sentinel is built by printf, so the command echoed by the
+        # shell never matches it
+        self.channel.send(
+            "cd %s && %s\nprintf '\\n%%s%%s:%%d\\n' __USINE_ %s $?\n"
+            % (cwd, command, token))
+        sentinel = compile_regex(r'\r?\n__USINE_%s:(\d+)\r?\n' % token)
+
+        buffer = ''
+        while True:
+            select([self.channel], [], [], 1.0)
+            if not self.channel.recv_ready():
+                if self.channel.closed:
+                    raise EnvironmentError('the remote shell was closed')
+                continue
+            buffer += self.channel.recv(32768)
+            match = sentinel.search(buffer)
+            if match:
+                write(buffer[:match.start()])
+                return int(match.group(1))
+            # Keep the last line, it may be the start of the sentinel
+            end = buffer.rfind('\n', 0, len(buffer) - 1)
+            if end > 0:
+                write(buffer[:end])
+                buffer = buffer[end:]
+
+
+
+def run_without_shell(channel, cwd, command, result, write=None):
+    """Run the command over the channel, keep its output in 'result'
+    and pass it to 'write' as it comes (if given).  Return the exit status.
+    """
     command = 'cd %s && %s' % (cwd, command)
 
     # Call
     channel.exec_command(command)
-    status = channel.recv_exit_status()
-    if status:
-        print 'ERROR'
-        data = channel.recv_stderr(512)
-        while data:
-            stdout.write(data)
-            stdout.flush()
-            data = channel.recv_stderr(512)
-    else:
-        data = channel.recv(512)
-        while data:
-            stdout.write(data)
-            stdout.flush()
-            data = channel.recv(512)
+    # Stream stdout and stderr as they come
+    while True:
+        select([channel], [], [], 1.0)
+        # The output comes before the exit status, so check it first
+        exited = channel.exit_status_ready()
+        stdout_ready = channel.recv_ready()
+        if stdout_ready:
+            data = channel.recv(32768)
+            result.stdout.write(data)
+            if write:
+                write(data)
+        stderr_ready = channel.recv_stderr_ready()
+        if stderr_ready:
+            data = channel.recv_stderr(32768)
+            result.stderr.write(data)
+            if write:
+                write(data)
+        # Done once the command exited and the output is read
+        if exited and not (stdout_ready or stderr_ready):
+            break
+
+    return channel.recv_exit_status()
+
+
+
+paramiko_log = None
+
+def import_paramiko():
+    """Import paramiko on first use, return what is needed to connect.
+    """
+    global paramiko_log
+
+    # Import from paramiko
+    from paramiko import AutoAddPolicy, SSHClient, PasswordRequiredException
+    from paramiko.util import log_to_file
+
+    # Add log
+    if paramiko_log is None:
+        paramiko_log = expanduser('~/.usine/paramiko.log')
+        log_to_file(paramiko_log)
+
+    return SSHClient, AutoAddPolicy, PasswordRequiredException
 
 
 
-class RemoteHost(object):
+class RemoteHost(Host):
+
+    # Interval of the keepalive messages, in seconds (0 to disable)
+    keepalive = 0
 
     def __init__(self, host, user, shell):
         host, port = host.split(':')
@@ -151,8 +413,16 @@ class RemoteHost(object):
         self.port = int(port)
         self.user = user
         self.shell = shell # True or False
-        # Connection
+        self.cwd = '~'
+        # Connection, shared by the threads using this host
         self.ssh = None
+        self.lock = Lock()
+        self.last_used = time()
+        # Idle SFTP sessions, opened over the transport on demand
+        self.sftp_pool = []
+        # The shell session, if shell is True
+        self.shell_session = None
+        self.shell_lock = Lock()
 
 
     def chdir(self, cwd):
@@ -161,61 +431,300 @@ class RemoteHost(object):
 
     @property
     def transport(self):
-        if self.ssh is None:
-            log_info('Connect %s@%s:%s' % (self.user, self.host, self.port))
-            ssh = SSHClient()
-            ssh.load_system_host_keys()
-            ssh.set_missing_host_key_policy(AutoAddPolicy())
-            try:
-                ssh.connect(self.host, self.port, self.user)
-            except PasswordRequiredException:
-                password = getpass('Enter passphrase for key: ')
-                ssh.connect(self.host, self.port, self.user, password)
-            self.ssh = ssh
-        return self.ssh.get_transport()
+        with self.lock:
+            self.last_used = time()
+            # The connection may have been dropped while idle
+            if self.ssh and not self.ssh.get_transport().is_active():
+                self.ssh.close()
+                self.ssh = None
+                self.sftp_pool = []
+                self.shell_session = None
+            if self.ssh is None:
+                log_info('Connect %s@%s:%s' % (self.user, self.host, self.port))
+                SSHClient, AutoAddPolicy, PasswordRequiredException = \
+                    import_paramiko()
+                ssh = SSHClient()
+                ssh.load_system_host_keys()
+                ssh.set_missing_host_key_policy(AutoAddPolicy())
+                try:
+                    ssh.connect(self.host, self.port, self.user)
+                except PasswordRequiredException:
+                    password = getpass('Enter passphrase for key: ')
+                    ssh.connect(self.host, self.port, self.user, password)
+                if self.keepalive:
+                    ssh.get_transport().set_keepalive(self.keepalive)
+                self.ssh = ssh
+            return self.ssh.get_transport()
+
+
+    @contextmanager
+    def sftp(self):
+        """Use an SFTP session of the pool.  It is given back when done, or
+        closed if an error happened, since it may be broken.
+        """
+        ftp = self.get_sftp()
+        try:
+            yield ftp
+        except:
+            ftp.close()
+            raise
+        self.release_sftp(ftp)
 
 
-    def close(self):
-        if self.ssh:
-            self.ssh.close()
-            self.ssh = None
+    def get_sftp(self):
+        """Return an idle SFTP session, open a new one if there is none.
+        Give it back with 'release_sftp' when done.
+        """
+        with self.lock:
+            if self.sftp_pool:
+                return self.sftp_pool.pop()
+        return self.transport.open_sftp_client()
 
 
-    def run(self, command, cwd=None, quiet=False):
-        # Change dir
-        if cwd:
-            self.chdir(cwd)
+    def release_sftp(self, ftp):
+        with self.lock:
+            self.sftp_pool.append(ftp)
 
-        # Print
-        if quiet is False:
-            log_info('%s@%s %s $ %s' % (self.user, self.host, self.cwd, command))
 
-        channel = self.transport.open_channel('session')
-        try:
-            if self.shell:
-                run_with_shell(channel, self.cwd, command)
-            else:
-                run_without_shell(channel, self.cwd, command)
-        finally:
-            channel.close()
+    def close(self):
+        with self.lock:
+            for ftp in self.sftp_pool:
+                ftp.close()
+            self.sftp_pool = []
+            if self.shell_session:
+                self.shell_session.close()
+                self.shell_session = None
+            if self.ssh:
+                self.ssh.close()
+                self.ssh = None
+
+
+    def run(self, command, cwd=None, quiet=False, check=True):
+        # The working directory is per call, so concurrent tasks sharing
+        # this host do not change each other's
+        cwd = cwd or self.cwd
 
+        # Print
+        if quiet is False:
+            log_info('%s@%s %s $ %s' % (self.user, self.host, cwd, command))
 
-    def put(self, source, target):
-        ftp = self.transport.open_sftp_client()
-        with closing(ftp) as ftp:
-            target = target.replace('~', ftp.normalize('.'))
-            statinfo = ftp.stat(target)
-            if S_ISDIR(statinfo.st_mode):
-                target = '%s/%s' % (target, basename(source))
+        # The output is tagged with the host
+        with span(command, host=self.host, cwd=cwd) as tags, \
+             log_prefix(self.host):
             try:
-                statinfo = ftp.stat(target)
+                result = self.execute(command, cwd, write_output)
+                if result.status:
+                    write_output('ERROR\n')
+            finally:
+                end_output()
+            tags['status'] = result.status
+
+        if check:
+            result.check()
+        return result
+
+
+    def execute(self, command, cwd, write=None):
+        """Run the command and return its CommandResult, passing its
+        output to 'write' as it comes (if given).
+        """
+        result = CommandResult(command, self.host, cwd)
+        if self.shell:
+            # The shell has a terminal, stderr comes with stdout
+            def write_shell(data):
+                result.stdout.write(data)
+                if write:
+                    write(data)
+            status = self.run_in_shell(cwd, command, write_shell)
+        else:
+            channel = self.transport.open_channel('session')
+            try:
+                status = run_without_shell(channel, cwd, command, result,
+                                           write)
+            finally:
+                channel.close()
+        result.finish(status)
+        return result
+
+
+    def run_in_shell(self, cwd, command, write):
+        """Run the command in the shell session of this host, opened the
+        first time.  The commands of concurrent tasks run one at a time.
+        """
+        with self.shell_lock:
+            session = self.shell_session
+            if session is None or session.closed:
+                session = ShellSession(self.transport)
+                self.shell_session = session
+            return session.run(cwd, command, write)
+
+
+    def capture(self, command, cwd=None):
+        """Run the command and return its CommandResult, without printing
+        anything.
+        """
+        return self.execute(command, cwd or self.cwd)
+
+
+    def get_checksums(self, paths):
+        """Return a dict with the size and the SHA-1 of the given remote
+        files, computed with a single remote command.  Missing files are
+        not in the dict.
+        """
+        paths = ' '.join(paths)
+        command = "stat -c 'size %%s %%n' %s 2>/dev/null; sha1sum %s 2>/dev/null"
+        result = self.capture(command % (paths, paths))
+        sizes = {}
+        checksums = {}
+        for line in result.output.splitlines():
+            if line.startswith('size '):
+                x, size, path = line.split(' ', 2)
+                sizes[path] = int(size)
+            elif line:
+                checksum, path = line.split('  ', 1)
+                checksums[path] = checksum
+
+        return dict([ (x, (sizes[x], checksums[x]))
+                      for x in sizes if x in checksums ])
+
+
+    def get_checksum(self, path):
+        """Return the size and the SHA-1 of the given remote file, or None
+        if it does not exist.
+        """
+        return self.get_checksums([path]).get(path)
+
+
+    def read_file(self, path):
+        """Return the content of the remote file, or None if it does not
+        exist.
+        """
+        with self.sftp() as ftp:
+            path = path.replace('~', ftp.normalize('.'))
+            try:
+                remote_file = ftp.open(path)
             except IOError:
-                msg = 'PUT %s -> %s@%s:%s'
+                return None
+            with closing(remote_file):
+                return remote_file.read()
+
+
+    def write_file(self, path, data):
+        """Write the data to the remote file, through a temporary file so
+        the file is never left half written.
+        """
+        with self.sftp() as ftp:
+            path = path.replace('~', ftp.normalize('.'))
+            tmp = '%s.tmp' % path
+            with closing(ftp.open(tmp, 'w')) as remote_file:
+                remote_file.write(data)
+            ftp.posix_rename(tmp, path)
+
+
+    def put(self, source, target, delta=False):
+        """Copy the source file to the target (file or folder), unless the
+        remote file is already the same, same size and same SHA-1.
+
+        With 'delta' the file is sent with rsync, which only transfers the
+        differences with the remote file or a similar one in the target
+        folder.
+        """
+        self.put_many([source], target, delta=delta)
+
+
+    def put_many(self, sources, target, delta=False, jobs=4):
+        """Copy the source files to the target folder, 'jobs' files at a
+        time over the same connection.  The files already there, same size
+        and same SHA-1, are skipped.  See 'put' for 'delta'.
+        """
+        if delta:
+            def upload(source):
+                msg = 'RSYNC %s -> %s@%s:%s'
                 log_info(msg % (source, self.user, self.host, target))
-                ftp.put(source, target)
+                local.run(['rsync', '--checksum', '--fuzzy', '--times',
+                           '-e', 'ssh -p %d' % self.port, source,
+                           '%s@%s:%s' % (self.user, self.host, target)])
+            results = run_parallel(upload, sources, jobs)
+            self._check_uploads(results)
+            return
+
+        # Resolve the target
+        with self.sftp() as ftp:
+            target = target.replace('~', ftp.normalize('.'))
+            is_folder = S_ISDIR(ftp.stat(target).st_mode)
+
+        def get_target(source):
+            if is_folder:
+                return '%s/%s' % (target, basename(source))
+            return target
+
+        # Skip the files already uploaded
+        remote = self.get_checksums([ get_target(x) for x in sources ])
+        todo = []
+        for source in sources:
+            if remote.get(get_target(source)) == get_checksum(source):
+                log_info('[INFO] %s already uploaded, skipping.'
+                         % basename(source))
             else:
-                filename = basename(source)
-                log_info('[INFO] %s already uploaded, skipping.' % filename)
+                todo.append(source)
+
+        # Upload
+        def upload(source):
+            path = get_target(source)
+            msg = 'PUT %s -> %s@%s:%s'
+            log_info(msg % (source, self.user, self.host, path))
+            size = getsize(source)
+            # Report the progress of large files every 25%
+            step = size / 4 if size > 10 * 1024 * 1024 else size + 1
+            start = time()
+            with self.sftp() as ftp:
+                with span('put %s' % basename(source), host=self.host,
+                          path=path, bytes=size):
+                    with open(source, 'rb') as file:
+                        self._write(ftp, file, path, size, step)
+            duration = time() - start
+            log_info('[INFO] %s uploaded, %s in %.1fs (%s/s)'
+                     % (basename(source), format_size(size), duration,
+                        format_size(size / max(duration, 0.001))))
+            return size
+
+        start = time()
+        results = run_parallel(upload, todo, jobs)
+        duration = time() - start
+        uploaded = [ size for x, size, error in results if not error ]
+        if uploaded:
+            size = sum(uploaded)
+            log_info('[INFO] %d files uploaded, %s in %.1fs (%s/s)'
+                     % (len(uploaded), format_size(size), duration,
+                        format_size(size / max(duration, 0.001))))
+        self._check_uploads(results)
+
+
+    def _write(self, ftp, file, path, size, step):
+        """Copy the local file to the remote path, logging the progress
+        every 'step' bytes.
+        """
+        name = basename(file.name)
+        with closing(ftp.open(path, 'wb')) as remote_file:
+            # Do not wait for the ack of every write
+            remote_file.set_pipelined(True)
+            done = 0
+            data = file.read(32768)
+            while data:
+                remote_file.write(data)
+                done += len(data)
+                if done // step != (done - len(data)) // step:
+                    log_info('[INFO] %s %d%%' % (name, done * 100 / size))
+                data = file.read(32768)
+
+
+    def _check_uploads(self, results):
+        errors = [ (x, error) for x, size, error in results if error ]
+        if errors:
+            for source, error in errors:
+                log_error('[ERROR] upload of %s failed: %s' % (source, error))
+            raise EnvironmentError('%d uploads failed' % len(errors))
+
 
 
 # Singleton
@@ -223,12 +732,14 @@ local = LocalHost()
 
 # Cache
 remote_hosts = {}
+remote_hosts_lock = Lock()
 
 def get_remote_host(host, user, shell):
     key = (host, user, shell)
-    remote_host = remote_hosts.get(key)
-    if not remote_host:
-        remote_host = RemoteHost(host, user, shell)
-        remote_hosts[key] = remote_host
+    with remote_hosts_lock:
+        remote_host = remote_hosts.get(key)
+        if not remote_host:
+            remote_host = RemoteHost(host, user, shell)
+            remote_hosts[key] = remote_host
 
     return remote_host
@@ -25,7 +25,8 @@ class module(object):
 
     def __init__(self, options):
         self.name = options['__name__'].split()[1]
-        self.options = options.copy()
+        # The options are shared with the configuration, do not change them
+        self.options = options
 
 
     def get_actions(self):
@@ -15,31 +15,256 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from os.path import expanduser
-from time import sleep
+from fnmatch import fnmatchcase
+from functools import partial
+from json import dumps, loads
+from os import listdir, makedirs
+from os.path import basename, exists, expanduser
+from re import compile as compile_regex, sub
+from shutil import copyfile, rmtree
+import sys
+from threading import BoundedSemaphore, Lock
+from time import sleep, strftime, time
+from urllib2 import urlopen
 
 # Import from itools
 from itools.core import freeze, lazy
-from itools.fs import lfs, vfs
 from itools.log import log_info, log_error
 
 # Import from usine
+from cache import durations_cache, vhosts_index
 from config import config
 from hosts import local, get_remote_host
 from modules import module, register_module
-from libusine.utils import logWrapper
+from tasks import TaskGraph
+from libusine.utils import get_percentile, logWrapper, log_prefix
+from libusine.utils import output, run_parallel, span, write_output
 
 
 
+match_project = compile_regex(r'([A-Za-z0-9_.\-]+)').match
+
+# Print the vhosts of the catalogs given as arguments, one per line
 cmd_vhosts = """
+import sys
 from itools.database import Catalog, get_register_fields
-catalog = Catalog('./%s/catalog', get_register_fields(), read_only=True)
-vhosts = list(catalog.get_unique_values('vhosts'))
-vhosts.sort()
-for vhost in vhosts:
-    print vhost
+fields = get_register_fields()
+for path in sys.argv[1:]:
+    try:
+        catalog = Catalog('./%s/catalog' % path, fields, read_only=True)
+        vhosts = sorted(catalog.get_unique_values('vhosts'))
+    except Exception, error:
+        print 'error', path, str(error).replace(chr(10), ' ')
+        continue
+    for vhost in vhosts:
+        print 'vhost', path, vhost
 """
 
+# One semaphore per server, limiting the catalogs reindexed at the same time
+reindex_slots = {}
+reindex_slots_lock = Lock()
+
+def get_reindex_slots(server):
+    """Return the semaphore limiting the number of catalogs reindexed at
+    the same time on the given server, set by the 'reindex_jobs' option of
+    its section (default 1).
+    """
+    section = config.get_section('server', server)
+    jobs = section.options.get('reindex_jobs', '1') if section else '1'
+    jobs = max(1, int(jobs))
+    with reindex_slots_lock:
+        key = (server, jobs)
+        if key not in reindex_slots:
+            reindex_slots[key] = BoundedSemaphore(jobs)
+        return reindex_slots[key]
+
+
+
+# The vhosts of the fleet, as {'pyenvs': {<pyenv>: <time>}, 'vhosts':
+# {<vhost>: [[<server>, <pyenv>, <ikaaro>], ...]}}, where the time is when
+# the vhosts of the pyenv were collected.  They are collected again after
+# an hour.
+vhosts_index_lock = Lock()
+vhosts_index_ttl = 3600
+
+def get_vhosts_index():
+    return vhosts_index.get('index') or {'pyenvs': {}, 'vhosts': {}}
+
+
+def update_vhosts_index(server, name, vhosts):
+    """Replace the vhosts of the given pyenv in the fleet index.  'vhosts'
+    is a dict {<ikaaro>: [<vhost>, ...]}.
+    """
+    with vhosts_index_lock:
+        index = get_vhosts_index()
+        merged = {}
+        for vhost, locations in index['vhosts'].items():
+            locations = [ x for x in locations if x[1] != name ]
+            if locations:
+                merged[vhost] = locations
+        for ikaaro in sorted(vhosts):
+            for vhost in vhosts[ikaaro]:
+                merged.setdefault(vhost, []).append([server, name, ikaaro])
+        pyenvs = dict(index['pyenvs'])
+        pyenvs[name] = time()
+        vhosts_index.put('index', {'pyenvs': pyenvs, 'vhosts': merged})
+
+
+
+# The health checks of the current command, for the fleet summary
+health_checks = []
+health_checks_lock = Lock()
+
+def get_health_stats(checks):
+    """Return the number of instances probed and alive, and the
+    percentiles of the latencies of the instances alive (milliseconds).
+    """
+    latencies = [ x['latency'] for x in checks if x['ok'] ]
+    return {
+        'total': len(checks),
+        'ok': len(latencies),
+        'p50': get_percentile(latencies, 50),
+        'p95': get_percentile(latencies, 95),
+        'p99': get_percentile(latencies, 99)}
+
+
+
+def print_health_report(title, checks, as_json=False):
+    """Print the result of the health checks, either as a table or as a
+    single JSON line.  The JSON line is written without the log prefix,
+    so it can be parsed; the name of the environment is in it.
+    """
+    stats = get_health_stats(checks)
+    if as_json:
+        report = {'name': title, 'instances': checks, 'stats': stats}
+        output.write(sys.stdout, dumps(report, sort_keys=True) + '\n')
+        return
+
+    format_ms = lambda x: '-' if x is None else '%.1fms' % x
+    width = max([ len(x['name']) for x in checks ] + [8])
+    lines = ['%s  %-6s  %9s  %s\n' % ('Instance'.ljust(width), 'Status',
+                                      'Latency', 'Attempts')]
+    for check in checks:
+        line = '%s  %-6s  %9s  %s' % (check['name'].ljust(width),
+                                      'OK' if check['ok'] else 'DOWN',
+                                      format_ms(check['latency']),
+                                      check['attempts'])
+        if check['error'] and not check['ok']:
+            line = '%s  %s' % (line, check['error'])
+        lines.append(line + '\n')
+    lines.append('%s: %d/%d alive, p50 %s, p95 %s, p99 %s\n' % (
+        title, stats['ok'], stats['total'], format_ms(stats['p50']),
+        format_ms(stats['p95']), format_ms(stats['p99'])))
+    write_output(''.join(lines))
+
+
+
+def merge_requirements(paths, exclude):
+    """Return the lines of the given requirements files, without the
+    duplicated projects and without the projects in 'exclude'.
+    """
+    normalize = lambda x: x.lower().replace('_', '-')
+    seen = set([ normalize(x) for x in exclude ])
+    lines = []
+    for path in paths:
+        for line in open(path).readlines():
+            # Like pip, '#' starts a comment only at the start of the line
+            # or after a space, not in URLs (#egg=...)
+            requirement = sub(r'(^|\s)#.*$', '', line).strip()
+            if not requirement:
+                continue
+            # Options, like -e, are kept as they are
+            match = match_project(requirement)
+            if match and requirement[0] != '-':
+                project = normalize(match.group(1))
+                if project in seen:
+                    continue
+                seen.add(project)
+            lines.append(requirement + '\n')
+    return lines
+
+
+
+class Deployment(object):
+    """The state of a deploy.  Only the packages whose build differs from
+    the one recorded in the manifest of the host are uploaded and
+    installed, and the instances are only restarted if a package was.
+    """
+
+    def __init__(self, pyenv, force=False):
+        self.pyenv = pyenv
+        self.force = force
+        self.manifest = {}           # name: key, installed on the host
+        self.keys = {}               # name: key, built
+        self.deployed = []           # the packages installed by this deploy
+
+
+    def read_manifest(self):
+        if not self.force:
+            self.manifest = self.pyenv.read_manifest()
+
+
+    def write_manifest(self):
+        if self.deployed:
+            for name in self.deployed:
+                self.manifest[name] = self.keys[name]
+            self.pyenv.write_manifest(self.manifest)
+
+
+    def is_changed(self, name):
+        key = self.keys.get(name)
+        return self.force or key is None or self.manifest.get(name) != key
+
+
+    def build(self, name, version):
+        self.pyenv.build_package(name, version)
+        self.keys[name] = self.pyenv.get_package_key(name, version)
+
+
+    def upload(self, name, version):
+        if self.is_changed(name):
+            self.pyenv.upload_package(name, version)
+        else:
+            log_info('[SKIP] {} is already installed'.format(name))
+
+
+    def install(self, name, version):
+        if self.is_changed(name):
+            self.pyenv.install_package(name, version)
+            self.deployed.append(name)
+        else:
+            log_info('[SKIP] {} is already installed'.format(name))
+
+
+    def get_changed(self):
+        return [ x for x, version in self.pyenv.get_packages()
+                 if self.is_changed(x) ]
+
+
+    def upload_wheelhouse(self):
+        if self.get_changed():
+            self.pyenv.upload_wheelhouse()
+        else:
+            log_info('[SKIP] every package is already installed')
+
+
+    def install_wheels(self):
+        changed = self.get_changed()
+        if changed:
+            self.pyenv.install_wheels()
+            self.deployed.extend(changed)
+        else:
+            log_info('[SKIP] every package is already installed')
+
+
+    def restart(self, func):
+        if self.deployed:
+            func()
+        else:
+            log_info('[SKIP] no package changed, not restarted')
+
+
+
 class instance(module):
 
     @lazy
@@ -117,10 +342,38 @@ class pyenv(instance):
         return bin_pip
 
 
+    @lazy
+    def is_wheel(self):
+        """Whether to install wheels with a single pip command, instead of
+        installing every source distribution with setup.py.
+        """
+        return bool(int(self.options.get('wheel', '0')))
+
+
+    @lazy
+    def local_wheelhouse(self):
+        path = '~/.usine/cache/.wheelhouse/%s' % self.name.replace('/', '-')
+        return expanduser(path)
+
+
+    @lazy
+    def remote_wheelhouse(self):
+        return '/tmp/usine-wheelhouse-%s' % self.name.replace('/', '-')
+
+
+    @lazy
+    def remote_dist(self):
+        """The folder where the source distributions are uploaded and
+        unpacked, one per environment so concurrent deploys on the same
+        server do not share files.
+        """
+        return '/tmp/usine-dist-%s' % self.name.replace('/', '-')
+
+
     @lazy
     def class_actions(self):
         actions = ['start', 'stop', 'restart', 'update', 'reindex',
-                   'build', 'install', 'deploy', 'deploy_reindex']
+                   'build', 'install', 'deploy', 'deploy_reindex', 'lookup']
         if not self.is_local:
             # Append remote actions
             actions.extend(['upload', 'test', 'vhosts'])
@@ -132,6 +385,40 @@ class pyenv(instance):
         return [ x.split(':') for x in packages ]
 
 
+    @lazy
+    def manifest_path(self):
+        return '%s/.usine-manifest.json' % self.location[2]
+
+
+    def get_package_key(self, name, version):
+        """Return what identifies the build of the package, or None if
+        its working copy is modified.
+        """
+        kind = 'wheel' if self.is_wheel else 'sdist'
+        return self.get_source(name).get_build_key(kind, version)
+
+
+    def read_manifest(self):
+        """Return the packages installed by the last deploy, read from the
+        host, as a dict {<name>: <key>} (see get_package_key).
+        """
+        data = self.get_host().read_file(self.manifest_path)
+        if data is None:
+            return {}
+        try:
+            return loads(data)['packages']
+        except (ValueError, KeyError):
+            log_error('[ERROR] {} is not valid, ignored'.format(
+                self.manifest_path))
+            return {}
+
+
+    def write_manifest(self, packages):
+        data = {'packages': packages, 'time': strftime('%Y-%m-%d %H:%M:%S')}
+        data = dumps(data, indent=2, sort_keys=True)
+        self.get_host().write_file(self.manifest_path, data)
+
+
     def get_action(self, name):
         if name not in self.get_actions():
             # Ignore actions not specified in get_actions
@@ -139,6 +426,246 @@ class pyenv(instance):
         return super(pyenv, self).get_action(name)
 
 
+    def get_instances(self):
+        """Return the ikaaro instances that use this environment.
+        """
+        return config.get_sections_by_reference('ikaaro', 'pyenv', self.name)
+
+
+    def run_on_instances(self, get_commands):
+        """Run the commands returned by 'get_commands(ikaaro)' for every
+        ikaaro instance, concurrently over the connection to the host (see
+        the --jobs option).  Raise EnvironmentError if they failed on some
+        instances.
+        """
+        commands = [ (x.name, x.cwd, get_commands(x))
+                     for x in self.get_instances() ]
+        if not commands:
+            return
+        host = self.get_host()
+        statuses = host.run_concurrent(commands, config.options.jobs)
+        failed = [ name for (name, cwd, command), status
+                   in zip(commands, statuses) if status ]
+        if failed:
+            raise EnvironmentError(
+                'the commands failed on: {}'.format(', '.join(failed)))
+
+
+    def collect_vhosts(self, instances):
+        """Return the vhosts of the given ikaaro instances, as a dict
+        {<ikaaro>: [<vhost>, ...]}.  All the catalogs are read by a single
+        Python process on the host.
+        """
+        names = dict([ (x.options['path'], x.name) for x in instances ])
+        if not names:
+            return {}
+
+        host = self.get_host()
+        paths = sorted(names)
+        if self.is_local:
+            command = [self.bin_python, '-c', cmd_vhosts] + paths
+        else:
+            command = './bin/python -c "%s" %s' % (cmd_vhosts, ' '.join(paths))
+        output = host.capture(command, self.location[2]).check().output
+
+        vhosts = dict([ (x, []) for x in names.values() ])
+        for line in output.splitlines():
+            line = line.strip().split(' ', 2)
+            if len(line) != 3 or line[1] not in names:
+                continue
+            kind, path, value = line
+            if kind == 'vhost':
+                vhosts[names[path]].append(value)
+            elif kind == 'error':
+                log_error('[ERROR] {}: {}'.format(names[path], value))
+        return vhosts
+
+
+    def get_vhosts(self):
+        """Collect the vhosts of the ikaaro instances of this environment,
+        and return them as a dict {<ikaaro>: [<vhost>, ...]}.  They are
+        stored in the fleet index.
+        """
+        vhosts = self.collect_vhosts(self.get_instances())
+        update_vhosts_index(self.location[1], self.name, vhosts)
+        return vhosts
+
+
+    def get_rolling_batch(self):
+        """Return the number of ikaaro instances to restart at a time in a
+        rolling restart, or 0 to restart them all without health checks.
+        """
+        batch = config.options.rolling
+        if batch is None:
+            batch = int(self.options.get('rolling', '0'))
+        return batch
+
+
+    def rolling_restart(self, batch):
+        """Restart the ikaaro instances 'batch' at a time.  Every batch must
+        answer to the ';_ctrl' probe before the next one is restarted.
+        """
+        instances = self.get_instances()
+        for i in range(0, len(instances), batch):
+            instances_batch = instances[i:i + batch]
+            names = ', '.join([ x.name for x in instances_batch ])
+            log_info('RESTART {}'.format(names))
+
+            def restart(ikaaro):
+                with log_prefix(ikaaro.name), span(ikaaro.name):
+                    ikaaro.stop()
+                    ikaaro.start()
+                    if 'uri' not in ikaaro.options:
+                        log_info('[WARNING] no uri, health check skipped')
+                        return True
+                    return ikaaro.is_alive(attempts=20)
+
+            results = run_parallel(restart, instances_batch, batch)
+            failed = [ ikaaro.name for ikaaro, alive, error in results
+                       if error or not alive ]
+            if failed:
+                raise EnvironmentError(
+                    'rolling restart stopped, unhealthy instances: {}'.format(
+                        ', '.join(failed)))
+
+
+    def build_package(self, name, version):
+        """Build the given package, return the path to the wheel in wheel
+        mode.
+        """
+        source = self.get_source(name)
+        if self.is_wheel:
+            if source.get_action('sync'):
+                source.action_sync()
+            with source.get_worktree_lock(version):
+                source.action_checkout(version)
+                return source.action_wheel(version)
+        elif self.is_local:
+            source.action_sync()
+            source.action_checkout(version)
+        else:
+            # If we build for remote we want to build a dist
+            source.action_dist(version)
+
+
+    def make_wheelhouse(self):
+        """Gather the wheels and their requirements in the local wheelhouse.
+        """
+        wheelhouse = self.local_wheelhouse
+        if exists(wheelhouse):
+            rmtree(wheelhouse)
+        makedirs(wheelhouse)
+        packages = self.get_packages()
+        wheels = [ self.get_source(name).get_wheel(version)
+                   for name, version in packages ]
+        for wheel in wheels:
+            copyfile(wheel, '%s/%s' % (wheelhouse, basename(wheel)))
+        requirements = [ self.get_source(name).get_requirements(version)
+                         for name, version in packages ]
+        requirements = merge_requirements(
+            [ x for x in requirements if x ],
+            [ basename(x).split('-')[0] for x in wheels ])
+        with open('%s/requirements.txt' % wheelhouse, 'w') as file:
+            file.write(''.join(requirements))
+
+
+    def get_dist(self, name, version):
+        """Return the path to the source distribution of the package.
+        """
+        source = self.get_source(name)
+        pkgname = source.get_pkgname(version)
+        return '%s/dist/%s.tar.gz' % (source.get_path(version), pkgname)
+
+
+    def upload(self, paths, target, jobs):
+        host = self.get_host()
+        delta = self.options.get('upload') == 'rsync'
+        host.put_many(paths, target, delta=delta, jobs=jobs)
+
+
+    def upload_dists(self, paths, jobs):
+        self.get_host().run('mkdir -p %s' % self.remote_dist)
+        self.upload(paths, self.remote_dist, jobs)
+
+
+    def upload_package(self, name, version):
+        self.upload_dists([self.get_dist(name, version)], 1)
+
+
+    def upload_wheelhouse(self):
+        wheelhouse = self.local_wheelhouse
+        paths = [ '%s/%s' % (wheelhouse, x) for x in listdir(wheelhouse) ]
+        self.get_host().run('mkdir -p %s' % self.remote_wheelhouse)
+        self.upload(paths, self.remote_wheelhouse, config.options.jobs)
+
+
+    def get_install_commands(self):
+        """Return the commands to install the requirements of a package,
+        and to install the package.
+        """
+        install_command = '%s setup.py --quiet install --force' % self.bin_python
+        pip_install_command = '%s install -r requirements.txt --upgrade' % self.bin_pip
+        prefix = self.options.get('prefix')
+        if prefix:
+            pip_install_command += ' --prefix=%s' % prefix
+            install_command += ' --prefix=%s' % prefix
+        return pip_install_command, install_command
+
+
+    def install_package(self, name, version):
+        """Install the package and its requirements, from the source on
+        localhost or from the source distribution uploaded to remote_dist.
+        """
+        host = self.get_host()
+        source = self.get_source(name)
+        if self.is_local:
+            path = source.get_path(version)
+        else:
+            # If remove we need to untar sources
+            log_info('UNTAR sources for {}'.format(name))
+            pkgname = source.get_pkgname(version)
+            host.run('tar xzf %s.tar.gz' % pkgname, self.remote_dist)
+            path = '%s/%s' % (self.remote_dist, pkgname)
+
+        # Failures raise CommandError, so the package is not recorded as
+        # deployed
+        pip_install_command, install_command = self.get_install_commands()
+        if not host.capture('test -f requirements.txt', path).status:
+            log_info('INSTALL DEPENDENCIES for {}'.format(name))
+            host.run(pip_install_command, path)
+        else:
+            log_info('No file requirements.txt found, ignore')
+        # Install
+        log_info('INSTALL package {}'.format(name))
+        host.run(install_command, path)
+
+        if not self.is_local:
+            # Clean untar sources
+            log_info('DELETE untar sources {}'.format(path))
+            host.run('rm -rf %s' % path, self.remote_dist)
+
+
+    def install_wheels(self):
+        """Install the wheels and all the requirements at once.
+        """
+        if self.is_local:
+            wheelhouse = self.local_wheelhouse
+        else:
+            wheelhouse = self.remote_wheelhouse
+        names = listdir(self.local_wheelhouse)
+        wheels = [ '%s/%s' % (wheelhouse, x) for x in names
+                   if x.endswith('.whl') ]
+        command = ('%s install --upgrade --find-links=%s '
+                   '-r %s/requirements.txt %s')
+        command = command % (self.bin_pip, wheelhouse, wheelhouse,
+                             ' '.join(wheels))
+        prefix = self.options.get('prefix')
+        if prefix:
+            command += ' --prefix=%s' % prefix
+        log_info('INSTALL {} packages'.format(len(wheels)))
+        self.get_host().run(command, wheelhouse)
+
+
     build_title = u'Build the source code this Python environment requires'
     @logWrapper
     def action_build(self):
@@ -146,32 +673,46 @@ class pyenv(instance):
         """
         # Get .cache folder
         path = expanduser('~/.usine/cache')
-        if not lfs.exists(path):
-            lfs.make_folder(path)
+        if not exists(path):
+            makedirs(path)
 
-        for name, version in self.get_packages():
-            config.options.version = version
-            source = self.get_source(name)
-            if self.is_local:
-                source.action_sync()
-                source.action_checkout()
-            else:
-                # If we build for remote we want to build a dist
-                source.action_dist()
+        def build(package):
+            name, version = package
+            with log_prefix(name), span(name, version=version):
+                return self.build_package(name, version)
+
+        # Build the packages in a pool of workers
+        jobs = config.options.jobs
+        results = run_parallel(build, self.get_packages(), jobs)
+
+        # Summary
+        failed = []
+        for (name, version), x, error in results:
+            if error:
+                failed.append(name)
+                log_error('[ERROR] {} ({}): {}'.format(name, version, error))
+        if failed:
+            raise EnvironmentError(
+                'failed to build: {}'.format(', '.join(failed)))
+
+        if self.is_wheel:
+            self.make_wheelhouse()
 
 
     upload_title = u'Upload the source code to the remote server'
     @logWrapper
     def action_upload(self):
-        """Upload every required package to the remote host.
+        """Upload every required package to the remote host.  Set the
+        'upload' option to 'rsync' to only send the differences with the
+        previous upload.
         """
-        host = self.get_host()
-        for name, version in self.get_packages():
-            source = self.get_source(name)
-            # Upload
-            pkgname = source.get_pkgname()
-            l_path = '%s/dist/%s.tar.gz' % (source.get_path(), pkgname)
-            host.put(l_path, '/tmp')
+        if self.is_wheel:
+            self.upload_wheelhouse()
+            return
+
+        paths = [ self.get_dist(name, version)
+                  for name, version in self.get_packages() ]
+        self.upload_dists(paths, config.options.jobs)
 
 
     install_title = u'Install the source code into the Python environment'
@@ -180,49 +721,16 @@ class pyenv(instance):
         """Installs every required package (and dependencies) into the remote virtual
         environment.
         """
-        # Get host
-        host = self.get_host()
-        # Build commands
-        install_command = '%s setup.py --quiet install --force' % self.bin_python
-        pip_install_command = '%s install -r requirements.txt --upgrade' % self.bin_pip
-        prefix = self.options.get('prefix')
-        if prefix:
-            pip_install_command += ' --prefix=%s' % prefix
-            install_command += ' --prefix=%s' % prefix
-
-        # Get package install paths
-        paths = {}
-        for name, version in self.get_packages():
-            source = self.get_source(name)
-            if self.is_local:
-                source_path = source.get_path()
-                paths[name] = source_path
-            else:
-                # If remove we need to untar sources
-                log_info('UNTAR sources for {}'.format(name))
-                source = self.get_source(name)
-                pkgname = source.get_pkgname()
-                host.run('tar xzf %s.tar.gz' % pkgname, '/tmp')
-                source_path = '/tmp/%s' % pkgname
-                paths[name] = source_path
+        packages = self.get_packages()
+        if self.is_wheel:
+            self.install_wheels()
+        else:
+            for name, version in packages:
+                self.install_package(name, version)
 
-        # Install
-        for name, path in paths.iteritems():
-            try:
-                log_info('INSTALL DEPENDENCIES for {}'.format(name))
-                host.run(pip_install_command, path)
-            except EnvironmentError:
-                # In case there is no requirements.txt
-                log_info('No file requirements.txt found, ignore')
-                pass
-            # Install
-                log_info('INSTALL package {}'.format(name))
-            host.run(install_command, path)
-
-            if not self.is_local:
-                # Clean untar sources
-                log_info('DELETE untar sources {}'.format(path))
-                host.run('rm -rf %s' % path, '/tmp')
+        # Every package is installed, see Deployment
+        self.write_manifest(dict([ (x, self.get_package_key(x, y))
+                                   for x, y in packages ]))
 
 
     restart_title = u'Restart the ikaaro instances that use this environment'
@@ -230,22 +738,155 @@ class pyenv(instance):
     def action_restart(self):
         """Restarts every ikaaro instance.
         """
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.stop()
-                ikaaro.start()
+        batch = self.get_rolling_batch()
+        if batch > 0:
+            self.rolling_restart(batch)
+            return
+
+        self.run_on_instances(
+            lambda x: x.get_stop_commands() + [x.get_start_command()])
 
 
     reindex_title = u'Reindex the ikaaro instances that use this environment'
     @logWrapper
     def action_reindex(self):
-        """Reindex every ikaaro instance.
+        """Reindex every ikaaro instance.  The instances are reindexed
+        concurrently, up to the 'reindex_jobs' option of the server at a
+        time.
+        """
+        instances = self.get_instances()
+        done = []
+        done_lock = Lock()
+
+        def reindex(ikaaro):
+            with log_prefix(ikaaro.name), span(ikaaro.name):
+                elapsed = ikaaro.reindex()
+                with done_lock:
+                    done.append(ikaaro.name)
+                    log_info('REINDEX done in {:.1f}s ({}/{})'.format(
+                        elapsed, len(done), len(instances)))
+                return elapsed
+
+        results = run_parallel(reindex, instances, len(instances))
+
+        # Summary
+        failed = []
+        for ikaaro, elapsed, error in results:
+            if error:
+                failed.append(ikaaro.name)
+                log_error('[ERROR] {}: {}'.format(ikaaro.name, error))
+            else:
+                log_info('[OK] {} ({:.1f}s)'.format(ikaaro.name, elapsed))
+        if failed:
+            raise EnvironmentError(
+                'failed to reindex: {}'.format(', '.join(failed)))
+
+
+    def get_deploy_graph(self, last):
+        """Return the tasks of a deploy, where 'last' is what to do with
+        the ikaaro instances once the packages are installed: 'restart' or
+        'reindex'.
+
+        Every package is uploaded as soon as it is built, and installed
+        once uploaded, after the package before it.  In wheel mode the
+        wheels are installed together, once all are built.  The packages
+        already installed are skipped, see Deployment.  The manifest is
+        written last, so if the instances fail to restart the next deploy
+        restarts them again.
+        """
+        graph = TaskGraph()
+        server = self.location[1]
+        remote = not self.is_local
+        deployment = Deployment(self, config.options.force)
+
+        manifest = graph.add('read manifest', deployment.read_manifest,
+                             host=server)
+        builds = []
+        installs = []
+        for name, version in self.get_packages():
+            task = graph.add('build %s' % name,
+                             partial(deployment.build, name, version),
+                             host='localhost')
+            builds.append(task)
+            if self.is_wheel:
+                continue
+            if remote:
+                task = graph.add('upload %s' % name,
+                                 partial(deployment.upload, name, version),
+                                 [task, manifest], server)
+            # Install the packages in order
+            task = graph.add('install %s' % name,
+                             partial(deployment.install, name, version),
+                             [task, manifest] + installs[-1:], server)
+            installs.append(task)
+
+        if self.is_wheel:
+            task = graph.add('wheelhouse', self.make_wheelhouse, builds,
+                             'localhost')
+            if remote:
+                task = graph.add('upload wheelhouse',
+                                 deployment.upload_wheelhouse,
+                                 [task, manifest], server)
+            task = graph.add('install wheels', deployment.install_wheels,
+                             [task, manifest], server)
+            installs.append(task)
+
+        # The ikaaro instances
+        deps = installs[-1:] or [manifest]
+        batch = self.get_rolling_batch()
+        if last == 'restart' and batch > 0:
+            func = partial(self.rolling_restart, batch)
+            lasts = [graph.add('rolling restart',
+                               partial(deployment.restart, func), deps,
+                               server)]
+        else:
+            lasts = []
+            for ikaaro in self.get_instances():
+                func = getattr(ikaaro, last)
+                if last == 'restart':
+                    func = partial(deployment.restart, func)
+                lasts.append(graph.add('%s %s' % (last, ikaaro.name), func,
+                                       deps, server))
+
+        graph.add('write manifest', deployment.write_manifest, lasts or deps,
+                  server)
+        return graph
+
+
+    def deploy(self, last):
+        """Run the tasks of a deploy (see get_deploy_graph), or print
+        them with --plan.
         """
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.stop()
-                ikaaro.update_catalog()
-                ikaaro.start()
+        graph = self.get_deploy_graph(last)
+        key = self.name.replace('/', '-')
+        estimates = durations_cache.get(key) or {}
+        if config.options.plan:
+            graph.print_plan(estimates)
+            return
+
+        # Get .cache folder
+        path = expanduser('~/.usine/cache')
+        if not exists(path):
+            makedirs(path)
+
+        # The tasks working on the server, at most the 'jobs' option of its
+        # section at a time
+        jobs = config.options.jobs
+        limits = {'localhost': jobs}
+        section = config.get_section('server', self.location[1])
+        if section and 'jobs' in section.options:
+            limits[self.location[1]] = max(1, int(section.options['jobs']))
+        failed = graph.run(jobs, limits)
+
+        # Keep the durations for the next plans
+        for task in graph.tasks:
+            if task.state == 'done':
+                estimates[task.name] = task.duration
+        durations_cache.put(key, estimates)
+
+        if failed:
+            raise EnvironmentError('failed tasks: {}'.format(
+                ', '.join([ x.name for x in failed ])))
 
 
     deploy_title = u'All of the above'
@@ -255,11 +896,7 @@ class pyenv(instance):
         packages in the remote virtual environment, and restart all the ikaaro
         instances.
         """
-        actions = ['build', 'upload', 'install', 'restart']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+        self.deploy('restart')
 
 
     deploy_reindex_title = (
@@ -269,13 +906,10 @@ class pyenv(instance):
         """
         Build, upload, install the required Python packages
         in the remote virtual environment and stop, reindex and start all the
-        ikaaro instances.
+        ikaaro instances.  The reindex stops and starts every instance, so the
+        instances waiting for their turn keep running.
         """
-        actions = ['build', 'upload', 'install', 'stop', 'reindex', 'start']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+        self.deploy('reindex')
 
 
     update_title = (u'Launch update methods on the ikaaro '
@@ -285,12 +919,7 @@ class pyenv(instance):
         """
         Launch update methods on every ikaaro instance.
         """
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                try:
-                    ikaaro.update()
-                except EnvironmentError as e:
-                    log_error('[ERROR] ' + str(e))
+        self.run_on_instances(lambda x: x.get_update_command())
 
 
     start_title = (
@@ -300,9 +929,7 @@ class pyenv(instance):
         """
         Start all the ikaaro instances.
         """
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.start()
+        self.run_on_instances(lambda x: x.get_start_command())
 
 
     stop_title = (
@@ -312,28 +939,47 @@ class pyenv(instance):
         """
         Stop all the ikaaro instances.
         """
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.stop()
+        self.run_on_instances(lambda x: x.get_stop_commands())
 
 
     test_title = (
         u'Test if ikaaro instances of this Python environment are alive')
     @logWrapper
     def action_test(self):
-        """ Test if ikaaro instances of this Python environment are alive"""
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                uri = ikaaro.options['uri']
-                for i in range(1, 6):
-                    try:
-                        vfs.open('{}/;_ctrl'.format(uri))
-                    except Exception:
-                        log_error('[ERROR {}/5] {}'.format(i, uri))
-                        sleep(0.5)
-                    else:
-                        log_info('[OK] {}'.format(uri))
-                        break
+        """Probe the ikaaro instances of this Python environment
+        concurrently, and report the latency of every instance and the
+        percentiles.  Fail if an instance is down.
+        """
+        options = config.options
+        instances = []
+        for ikaaro in self.get_instances():
+            if 'uri' in ikaaro.options:
+                instances.append(ikaaro)
+            else:
+                log_info('[WARNING] {} has no uri, skipped'.format(ikaaro.name))
+
+        def probe(ikaaro):
+            with log_prefix(ikaaro.name), span(ikaaro.name):
+                return ikaaro.probe(timeout=options.timeout)
+
+        checks = []
+        for ikaaro, check, error in run_parallel(probe, instances,
+                                                 len(instances)):
+            if error:
+                check = {'name': ikaaro.name, 'uri': ikaaro.options['uri'],
+                         'ok': False, 'latency': None, 'attempts': 0,
+                         'error': str(error)}
+            check['pyenv'] = self.name
+            checks.append(check)
+
+        with health_checks_lock:
+            health_checks.extend(checks)
+        print_health_report(self.name, checks, options.json)
+
+        down = [ x['name'] for x in checks if not x['ok'] ]
+        if down:
+            raise EnvironmentError(
+                'instances down: {}'.format(', '.join(down)))
 
 
     vhosts_title = (
@@ -341,9 +987,52 @@ class pyenv(instance):
     @logWrapper
     def action_vhosts(self):
         """List vhosts of all ikaaro instances of this Python environment"""
-        for ikaaro in config.get_sections_by_type('ikaaro'):
-            if ikaaro.options['pyenv'] == self.name:
-                ikaaro.vhosts()
+        vhosts = self.get_vhosts()
+        for name in sorted(vhosts):
+            with log_prefix(name):
+                for vhost in vhosts[name]:
+                    write_output('%s\n' % vhost)
+
+
+    lookup_title = u'Find the ikaaro instances serving the --vhost domain'
+    @logWrapper
+    def action_lookup(self):
+        """Print the ikaaro instances of the whole fleet serving the
+        domain given by --vhost (may be a glob pattern, like
+        '*.example.com'), whatever the Python environment given.
+
+        The answer comes from the local fleet index; only the Python
+        environments missing from it, or collected more than an hour ago,
+        are collected again from their hosts (--parallel at a time).
+        """
+        pattern = config.options.vhost
+        if not pattern:
+            log_error('Error: the lookup action requires the --vhost option')
+            exit(1)
+
+        # Refresh what is missing or too old
+        collected = get_vhosts_index()['pyenvs']
+        stale = [ x for x in config.get_sections_by_type('pyenv')
+                  if time() - collected.get(x.name, 0) > vhosts_index_ttl ]
+        if stale:
+            results = run_parallel(lambda x: x.get_vhosts(), stale,
+                                   config.options.parallel)
+            for pyenv, x, error in results:
+                if error:
+                    log_error('[ERROR] {}: {}'.format(pyenv.name, error))
+
+        vhosts = get_vhosts_index()['vhosts']
+        if pattern in vhosts:
+            names = [pattern]
+        else:
+            names = [ x for x in sorted(vhosts) if fnmatchcase(x, pattern) ]
+        # Skip the Python environments removed from the configuration
+        pyenvs = set(config.get_section_names('pyenv'))
+        for vhost in names:
+            for server, pyenv, ikaaro in vhosts[vhost]:
+                if pyenv in pyenvs:
+                    write_output('%s %s %s %s\n' % (vhost, server, pyenv,
+                                                    ikaaro))
 
 
 
@@ -367,50 +1056,129 @@ class ikaaro(instance):
         return '%s/bin' % prefix
 
 
+    @lazy
+    def cwd(self):
+        return self.pyenv.location[2]
+
+
     def get_host(self):
-        pyenv = self.pyenv
-        host = pyenv.get_host()
-        cwd = pyenv.location[2]
-        host.chdir(cwd)
-        return host
+        return self.pyenv.get_host()
 
 
-    def stop(self):
+    def get_stop_commands(self):
         path = self.options['path']
-        host = self.get_host()
-        host.run('%s/icms-stop.py %s' % (self.bin_icms, path))
-        host.run('%s/icms-stop.py --force %s' % (self.bin_icms, path))
+        return ['%s/icms-stop.py %s' % (self.bin_icms, path),
+                '%s/icms-stop.py --force %s' % (self.bin_icms, path)]
 
 
-    def start(self, readonly=False):
+    def get_start_command(self, readonly=False):
         path = self.options['path']
         cmd = '%s/icms-start.py -d %s' % (self.bin_icms, path)
         readonly = readonly or self.options.get('readonly', False)
         if readonly:
             cmd = cmd + ' -r'
+        return cmd
+
+
+    def get_update_command(self):
+        path = self.options['path']
+        return '{0}/icms-update.py {1}'.format(self.bin_icms, path)
+
+
+    # The commands raise CommandError when they fail, on remote hosts too,
+    # so a failed reindex is reported
+    def stop(self):
         host = self.get_host()
-        host.run(cmd)
+        for cmd in self.get_stop_commands():
+            host.run(cmd, self.cwd)
+
+
+    def start(self, readonly=False):
+        host = self.get_host()
+        host.run(self.get_start_command(readonly), self.cwd)
 
 
     def update_catalog(self):
         path = self.options['path']
         cmd = '{0}/icms-update-catalog.py -y {1} --quiet'.format(self.bin_icms, path)
         host = self.get_host()
-        host.run(cmd)
+        host.run(cmd, self.cwd)
+
+
+    def reindex(self):
+        """Stop the instance, update its catalog and start it again, once
+        the server allows one more reindex (see get_reindex_slots).  Return
+        the time it took, in seconds.
+        """
+        slots = get_reindex_slots(self.pyenv.location[1])
+        if not slots.acquire(False):
+            log_info('REINDEX waiting for a free slot on the server')
+            slots.acquire()
+        try:
+            start = time()
+            log_info('REINDEX stop')
+            self.stop()
+            log_info('REINDEX update catalog')
+            self.update_catalog()
+            log_info('REINDEX start')
+            self.start()
+            return time() - start
+        finally:
+            slots.release()
+
+
+    def restart(self):
+        self.stop()
+        self.start()
 
 
     def update(self):
-        path = self.options['path']
-        cmd = '{0}/icms-update.py {1}'.format(self.bin_icms, path)
         host = self.get_host()
-        host.run(cmd)
+        host.run(self.get_update_command(), self.cwd)
+
+
+    def probe(self, attempts=5, delay=0.5, timeout=5, max_delay=8):
+        """Send the ';_ctrl' probe to the instance, up to 'attempts' times.
+        Every request times out after 'timeout' seconds.  The first retry
+        waits 'delay' seconds, every next one twice as long (up to
+        'max_delay').
+
+        Return a dict with the outcome, the latency of the answer (in
+        milliseconds), the number of attempts and the last error.
+        """
+        uri = '{}/;_ctrl'.format(self.options['uri'])
+        check = {'name': self.name, 'uri': uri, 'ok': False, 'latency': None,
+                 'attempts': 0, 'error': None}
+        for i in range(1, attempts + 1):
+            check['attempts'] = i
+            start = time()
+            try:
+                urlopen(uri, timeout=timeout).read()
+            except Exception as error:
+                check['error'] = str(error)
+                log_error('[ERROR {}/{}] {}: {}'.format(i, attempts, uri,
+                                                       error))
+                if i < attempts:
+                    sleep(min(delay * 2 ** (i - 1), max_delay))
+            else:
+                check['ok'] = True
+                check['latency'] = (time() - start) * 1000
+                log_info('[OK] {} ({:.1f}ms)'.format(uri, check['latency']))
+                return check
+        return check
+
+
+    def is_alive(self, attempts=5, delay=0.5):
+        """Return whether the instance answers to the ';_ctrl' probe, trying
+        up to 'attempts' times.
+        """
+        return self.probe(attempts, delay)['ok']
 
 
     def vhosts(self):
-        path = self.options['path']
-        host = self.get_host()
-        cmd = cmd_vhosts % path
-        host.run('./bin/python -c "%s"' % cmd, quiet=True)
+        vhosts = self.pyenv.collect_vhosts([self])
+        for vhost in vhosts[self.name]:
+            write_output('%s\n' % vhost)
 
 
     start_title = u'Start an ikaaro instance'
@@ -428,16 +1196,13 @@ class ikaaro(instance):
     restart_title = u'(Re)Start an ikaaro instance'
     @logWrapper
     def action_restart(self):
-        self.stop()
-        self.start()
+        self.restart()
 
 
     reindex_title = u'Update catalog of an ikaaro instance'
     @logWrapper
     def action_reindex(self):
-        self.stop()
-        self.update_catalog()
-        self.start()
+        self.reindex()
 
 
     update_title = u'Launch update methods of an ikaaro instance'
@@ -15,28 +15,70 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from sys import prefix, executable
-from os.path import expanduser
+from os import listdir, makedirs
+from os.path import exists, expanduser, join
+from re import sub
+from sys import prefix, executable, version as python_version
+from shutil import copyfile
+from threading import Lock, RLock
 
 # Import from itools
-from itools.fs import lfs
+from itools.log import log_info
 
 # Import from usine
+from cache import get_key, metadata_cache, sdist_cache, wheel_cache
 from config import config
 from hosts import local
 from modules import module, register_module
 from utils import logWrapper
 
 
+def find_wheel(folder, name, version):
+    """Return the path to the wheel of the given project and version in
+    the folder.  In wheel filenames the runs of characters other than
+    letters, digits and dots are replaced by an underscore, in the name and
+    in the version.
+    """
+    escape = lambda x: sub(r'[^A-Za-z0-9.]+', '_', x).lower()
+    start = '%s-%s-' % (escape(name), escape(version))
+    names = []
+    if exists(folder):
+        names = [ x for x in listdir(folder)
+                  if x.endswith('.whl') and x.lower().startswith(start) ]
+    if not names:
+        raise EnvironmentError(
+            'no wheel of %s %s found in %s' % (name, version, folder))
+    return join(folder, sorted(names)[-1])
+
+
+
+# One lock per repository or worktree, so concurrent tasks change them in
+# turn.  They are reentrant, so a task may hold the lock of a worktree from
+# the checkout through the end of the build.
+locks = {}
+locks_lock = Lock()
+
+def get_lock(path):
+    with locks_lock:
+        return locks.setdefault(path, RLock())
+
+
+
 class pysrc(module):
+    """The source is cloned once, in ~/.usine/cache/<name>, and every
+    version is checked out in its own worktree sharing that repository, in
+    ~/.usine/cache/.worktrees/<name>/<version>.  So switching versions does
+    not throw away the build outputs, and different versions can be built
+    at the same time.
+    """
 
     class_title = u'Manage Python packages'
 
 
     def get_actions(self):
         if config.options.offline:
-            return ['checkout', 'build', 'dist']
-        return ['sync', 'checkout', 'build', 'dist']
+            return ['checkout', 'build', 'wheel', 'dist']
+        return ['sync', 'checkout', 'build', 'wheel', 'dist']
 
 
     def get_action(self, name):
@@ -45,17 +87,77 @@ class pysrc(module):
         return super(pysrc, self).get_action(name)
 
 
-    def get_pkgname(self):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        return local.run([executable, 'setup.py', '--fullname']).strip()
+    def get_metadata(self, version=None):
+        """Return the name, version, fullname and requirements of the
+        package.  They are read once per commit and setup.py, and kept in
+        the cache.
+        """
+        cwd = self.get_path(version)
+        commit = local.run(['git', 'rev-parse', 'HEAD'], cwd).output.strip()
+        with open('%s/setup.py' % cwd) as file:
+            setup = file.read()
+        key = get_key('metadata', commit, setup)
+        metadata = metadata_cache.get(key)
+        if metadata is not None:
+            return metadata
+
+        command = [executable, 'setup.py', '--name', '--version', '--fullname']
+        output = local.run(command, cwd).output.splitlines()
+        name, pkgversion, fullname = [ x.strip() for x in output[-3:] ]
+        requirements = self.get_requirements(version)
+        if requirements:
+            with open(requirements) as file:
+                requirements = [ x.strip() for x in file.readlines() ]
+            requirements = [ x for x in requirements
+                             if x and not x.startswith('#') ]
+        metadata = {'name': name, 'version': pkgversion, 'fullname': fullname,
+                    'requirements': requirements or []}
+        metadata_cache.put(key, metadata)
+        return metadata
+
 
+    def get_pkgname(self, version=None):
+        return self.get_metadata(version)['fullname']
 
-    def get_path(self):
+
+    def get_build_key(self, kind, version=None):
+        """Return the key of the artifact of the given kind ('sdist' or
+        'wheel') in the cache, made from the commits of the source and its
+        submodules, and the Python used to build it.  Return None if the
+        working copy is modified.  The untracked files are ignored, like the
+        build outputs (dist, egg-info).
+        """
+        cwd = self.get_path(version)
+        command = ['git', 'status', '--porcelain', '--untracked-files=no']
+        if local.run(command, cwd).output.strip():
+            return None
+        commit = local.run(['git', 'rev-parse', 'HEAD'], cwd).output
+        submodules = local.run(['git', 'submodule', 'status', '--recursive'],
+                               cwd).output
+        return get_key(kind, commit, submodules, executable, python_version)
+
+
+    def get_repository(self):
         path = '~/.usine/cache/%s' % self.name.replace('/', '-')
         return expanduser(path)
 
 
+    def get_path(self, version=None):
+        """Return the path to the worktree of the given version.
+        """
+        version = self.get_version(version).replace('/', '-')
+        path = '~/.usine/cache/.worktrees/%s/%s' % (
+            self.name.replace('/', '-'), version)
+        return expanduser(path)
+
+
+    def get_worktree_lock(self, version=None):
+        """Return the lock of the worktree of the given version, to hold
+        from the checkout through the end of the build.
+        """
+        return get_lock(self.get_path(version))
+
+
     def get_url(self):
         mirror = self.options['mirror']
         mirror = config.get_section('mirror', mirror)
@@ -63,64 +165,190 @@ class pysrc(module):
         return '%s%s.git' % (mirror, self.name)
 
 
+    def get_wheel(self, version=None):
+        """Return the path to the wheel built in the dist folder.
+        """
+        metadata = self.get_metadata(version)
+        folder = '%s/dist' % self.get_path(version)
+        return find_wheel(folder, metadata['name'], metadata['version'])
+
+
+    def get_requirements(self, version=None):
+        """Return the path to the requirements file, or None.
+        """
+        path = '%s/requirements.txt' % self.get_path(version)
+        if exists(path):
+            return path
+        return None
+
+
+    def get_version(self, version=None):
+        """Return the given version, or the one from the command line.
+        """
+        if version:
+            return version
+        return getattr(config.options, 'branch', None) or 'master'
+
+
     def _checkout(self, version):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        on_tag = version.startswith('@')
-        if not on_tag:
-            # Checkout branch
-            try:
-                local.run(['git', 'checkout', version])
-            except EnvironmentError:
-                local.run(['git', 'checkout', '-b', version, 'origin/%s' % version])
-            else:
-                local.run(['git', 'reset', '--hard', 'origin/%s' % version])
+        repository = self.get_repository()
+        path = self.get_path(version)
+        if version.startswith('@'):
+            # Tag
+            with get_lock(repository):
+                local.run(['git', 'fetch', '--tags'], repository)
+            target = version[1:]
         else:
-            # Checkout tag
-            tag = version[1:]
-            local.run(['git', 'fetch', '--tags'])
-            local.run(['git', 'checkout', tag])
-        local.run('git clean -fxdq')
+            # Branch
+            target = 'origin/%s' % version
+
+        with self.get_worktree_lock(version):
+            if exists(path):
+                # Move the worktree, keeping the build outputs
+                local.run(['git', 'checkout', '--force', '--detach', target],
+                          path)
+            else:
+                with get_lock(repository):
+                    local.run(['git', 'worktree', 'prune'], repository)
+                    local.run(['git', 'worktree', 'add', '--detach', path,
+                               target], repository)
 
+            # Update submodules, several at a time
+            jobs = '--jobs=%s' % self.options.get('submodule_jobs', '8')
+            local.run(['git', 'submodule', 'update', '--init', '--recursive',
+                       jobs], path)
+            local.run(['git', 'submodule', 'update', '--remote', '--merge',
+                       jobs], path)
+
+
+    def get_clone_mode(self):
+        """Return how to clone the source: 'full', 'shallow' (the last
+        commit of every branch) or 'partial' (the file contents are fetched
+        when needed).  Set by the 'clone' option of the source, or of its
+        mirror.
+        """
+        mode = self.options.get('clone')
+        if mode is None:
+            mirror = config.get_section('mirror', self.options['mirror'])
+            mode = mirror.options.get('clone', 'full')
+        return mode
+
+
+    def get_mirror_store(self):
+        """Return the path to the object store shared by the sources of
+        the mirror.  The clones borrow its objects through their alternates,
+        so it must never be pruned (garbage collection is disabled in it):
+        removing an object from it would corrupt the clones.
+        """
+        path = '~/.usine/cache/.mirrors/%s.git' % self.options['mirror']
+        return expanduser(path)
+
+
+    def update_mirror_store(self):
+        """Copy the objects of the source to the store of its mirror, so
+        the next clones of the mirror borrow them instead of downloading
+        them again.
+        """
+        store = self.get_mirror_store()
+        with get_lock(store):
+            if not exists(store):
+                local.run(['git', 'init', '--bare', '--quiet', store])
+            # Also for the stores made before gc was disabled
+            git_config = ['git', '--git-dir', store, 'config']
+            local.run(git_config + ['gc.auto', '0'])
+            local.run(git_config + ['gc.pruneExpire', 'never'])
+            refspec = '+refs/remotes/origin/*:refs/usine/%s/*' % self.name
+            local.run(['git', '--git-dir', store, 'fetch', '--quiet',
+                       '--no-tags', self.get_repository(), refspec])
 
 
     sync_title = u'[private] Synchronize the source from the mirror'
     @logWrapper
     def action_sync(self):
-        folder = self.get_path()
-        if lfs.exists(folder):
-            # Case 1: Fetch
-            local.run('git fetch origin', cwd=folder)
-        else:
-            # Case 2: Clone
-            local.run(['git', 'clone', self.get_url(), folder])
-        # Update submodules
-        local.run(['git', 'submodule', 'update', '--init', '--recursive'], cwd=folder)
-        local.run(['git', 'submodule', 'update', '--remote', '--merge'], cwd=folder)
+        folder = self.get_repository()
+        mode = self.get_clone_mode()
+        with get_lock(folder):
+            if exists(folder):
+                # Case 1: Fetch
+                local.run('git fetch origin', cwd=folder)
+            else:
+                # Case 2: Clone, borrowing the objects from the mirror store
+                command = ['git', 'clone', '--reference-if-able',
+                           self.get_mirror_store()]
+                if mode == 'shallow':
+                    command += ['--depth', '1', '--no-single-branch']
+                elif mode == 'partial':
+                    command += ['--filter=blob:none']
+                local.run(command + [self.get_url(), folder])
+        # The store cannot be fed from incomplete repositories
+        if mode == 'full':
+            self.update_mirror_store()
 
 
     checkout_title = u'[private] Checkout the given branch (default: master)'
     @logWrapper
-    def action_checkout(self):
-        self._checkout(config.options.version)
+    def action_checkout(self, version=None):
+        self._checkout(self.get_version(version))
 
 
     build_title = u'[private] Build'
     @logWrapper
-    def action_build(self):
-        cwd = self.get_path()
-        local.chdir(cwd)
-        local.run([executable, 'setup.py', '--quiet', 'sdist'])
+    def action_build(self, version=None):
+        """Make the source distribution, or take it from the cache if the
+        source did not change.  Return the path to the tarball.
+        """
+        command = [executable, 'setup.py', '--quiet', 'sdist']
+        get_path = lambda: '%s/dist/%s.tar.gz' % (self.get_path(version),
+                                                  self.get_pkgname(version))
+        return self._build('sdist', sdist_cache, command, get_path, version)
+
+
+    wheel_title = u'[private] Build a wheel'
+    @logWrapper
+    def action_wheel(self, version=None):
+        """Make a wheel, or take it from the cache if the source did not
+        change.  Return the path to the wheel.
+        """
+        command = [executable, '-m', 'pip', 'wheel', '--no-deps',
+                   '--wheel-dir', 'dist', '.']
+        get_path = lambda: self.get_wheel(version)
+        return self._build('wheel', wheel_cache, command, get_path, version)
+
+
+    def _build(self, kind, cache, command, get_path, version):
+        with self.get_worktree_lock(version):
+            cwd = self.get_path(version)
+            key = self.get_build_key(kind, version)
+            if key:
+                cached = cache.get(key)
+                if cached:
+                    log_info('[CACHE] Using {}'.format(cached))
+                    if not exists('%s/dist' % cwd):
+                        makedirs('%s/dist' % cwd)
+                    filename = cached.rsplit('/', 1)[1]
+                    path = '%s/dist/%s' % (cwd, filename)
+                    copyfile(cached, path)
+                    return path
+
+            # Remove the outputs of the previous builds (build, egg-info),
+            # they could bring deleted modules into the new one
+            local.run(['git', 'clean', '-fdxq', '-e', 'dist/'], cwd)
+            local.run(command, cwd)
+            path = get_path()
+            if key:
+                cache.put(key, path)
+            return path
 
 
     dist_title = u'All of the above'
     @logWrapper
-    def action_dist(self):
-        actions = ['sync', 'checkout', 'build']
-        for name in actions:
-            action = self.get_action(name)
-            if action:
-                action()
+    def action_dist(self, version=None):
+        version = self.get_version(version)
+        if self.get_action('sync'):
+            self.action_sync()
+        with self.get_worktree_lock(version):
+            self.action_checkout(version)
+            return self.action_build(version)
 
 
 # Register
@@ -18,14 +18,19 @@
 # Import from the Standard Library
 from optparse import OptionParser, IndentedHelpFormatter
 from os.path import expanduser
+import sys
 from sys import exit
+from time import time
 
 # Import from itools
 from itools.log import register_logger, log_info
 
 # Import from usine
 from libusine import config, modules, remote_hosts
-from libusine.utils import UsineLogger
+from libusine.agent import UsineAgent, call_agent
+from libusine.modules_instance import health_checks, print_health_report
+from libusine.utils import UsineLogger, log_prefix, run_parallel, span
+from libusine.utils import output, tracer
 
 
 
@@ -44,9 +49,10 @@ class HelpFormatter(IndentedHelpFormatter):
 
 
 
-if __name__ == '__main__':
-    # Command line
-    usage = 'usine.py [options] <module> <item> <action>...'
+def get_parser():
+    usage = 'usine.py [options] <module> <items> <action>...'
+    usage += ('\n\n<items> is a comma separated list of item names, glob '
+              'patterns (prod-*), "all" or "group:<name>"')
     parser = OptionParser(usage, description='foo', formatter=HelpFormatter())
     parser.add_option('--offline', action='store_true',
         help='In this mode the source code will not be synchronized from the '
@@ -54,20 +60,65 @@ if __name__ == '__main__':
     parser.add_option('-b', '--branch', default='master',
         help='The branch to use (default: master), this option only applies '
              ' to some actions.')
-    options, args = parser.parse_args()
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help='The number of packages to build or upload, or of commands to '
+             'run on a host, concurrently (default: 1).')
+    parser.add_option('-p', '--parallel', type='int', default=1,
+        help='When several items are selected, the number of items to '
+             'process concurrently (default: 1).')
+    parser.add_option('--rolling', type='int', metavar='N',
+        help='Restart the ikaaro instances N at a time, checking they are '
+             'alive before restarting the next ones (overrides the '
+             '"rolling" option of the pyenv).')
+    parser.add_option('--vhost', metavar='DOMAIN',
+        help='The domain to find with the lookup action, may be a glob '
+             'pattern (*.example.com).')
+    parser.add_option('--timeout', type='float', default=5,
+        help='The timeout of the requests sent by the test action, in '
+             'seconds (default: 5).')
+    parser.add_option('--json', action='store_true',
+        help='Print the report of the test action as JSON lines, one per '
+             'Python environment and one for all of them.')
+    parser.add_option('--force', action='store_true',
+        help='Deploy every package, even the ones the manifest of the host '
+             'says are already installed.')
+    parser.add_option('--plan', action='store_true',
+        help='Print the tasks of the deploy actions, their dependencies and '
+             'the critical path, without running them.')
+    parser.add_option('--profile', metavar='FILE',
+        help='Write the time taken by every action, package, instance and '
+             'command to FILE, in the Chrome trace format, and print the '
+             'slowest steps.')
+    parser.add_option('--agent', action='store_true',
+        help='Run the command in the usine agent if it is running, to reuse '
+             'its connections.')
+    parser.add_option('--daemon', action='store_true',
+        help='Run the usine agent, which keeps the connections to the '
+             'remote hosts open between commands (see --agent).')
+    return parser
 
 
-    # Init logger
-    log_file_path = expanduser('~/.usine/usine.log')
-    logger = UsineLogger(log_file_path)
-    register_logger(logger, None)
 
-    # Configuration
-    error = config.load()
-    if error:
-        print error
-        exit(1)
-    config.options = options
+def write_profile(path):
+    """Write the timing spans to the given file, and print the slowest
+    steps.
+    """
+    tracer.write_trace(path)
+    output.flush()
+    print >> sys.stderr
+    print >> sys.stderr, 'Slowest steps (see %s):' % path
+    for step in tracer.get_slowest():
+        print >> sys.stderr, '%8.1fs  %s' % (step['duration'], step['path'])
+
+
+
+def main(argv, close=True):
+    """Run the command line given by 'argv', and exit.  When 'close' is
+    False, the connections to the remote hosts are kept open.
+    """
+    parser = get_parser()
+    options, args = parser.parse_args(argv)
+    usage = parser.usage
 
     # Case 0: Nothing, print help
     if not args:
@@ -81,6 +132,16 @@ if __name__ == '__main__':
                 print u'  %s: %s' % (name, module.class_title)
         exit(0)
 
+    # Record the timing spans, see --profile
+    tracer.reset(bool(options.profile))
+
+    # Configuration
+    config.options = options
+    error = config.load()
+    if error:
+        print error
+        exit(1)
+
     log_info('> Command : ' + ' '.join(args))
 
     # Get the module
@@ -97,48 +158,119 @@ if __name__ == '__main__':
 
     # Case 1: Just the module, print help
     if not args:
-        usage = 'usine.py [options] %s <item> <action>...'
+        usage = 'usine.py [options] %s <items> <action>...'
         print 'Usage:', usage % module_name
         print
         print 'Items:'
         print
-        for item in config.get_sections_by_type(module_name):
-            print '  %s' % item.name
+        for name in config.get_section_names(module_name):
+            print '  %s' % name
         exit(0)
 
-    # Get the item
-    item_name, args = args[0], args[1:]
-    item = config.get_section(module_name, item_name)
-    if not item:
+    # Get the items
+    selector, args = args[0], args[1:]
+    items = config.select_sections(module_name, selector)
+    if not items:
         print 'Error: "%s" module got unexpected "%s" item' \
-                % (module_name, item_name)
+                % (module_name, selector)
         exit(1)
 
     # Case 2: The module and the item, print help
     if not args:
         usage = 'usine.py [options] %s %s <action>...'
-        print 'Usage:', usage % (module_name, item_name)
+        print 'Usage:', usage % (module_name, selector)
         print
         print 'Actions:'
         print
-        for action in item.get_actions():
+        for action in items[0].get_actions():
             title = getattr(module, '%s_title' % action)
             action = action + " " * (15 - len(action))
             print '  %s: %s' % (action, title)
         exit(0)
 
-    # Case 3: The module, the item and the action(s)
-    for action_name in args:
-        # Get the action
-        if action_name not in item.get_actions():
-            print 'Error: "%s" module got unexpected "%s" action' \
-                    % (module_name, action_name)
-            exit(1)
-
-        # Call
-        action = item.get_action(action_name)
-        action()
-
-    # Close connections
-    for host in remote_hosts.values():
-        host.close()
+    # Case 3: The module, the item(s) and the action(s)
+    for item in items:
+        for action_name in args:
+            if action_name not in item.get_actions():
+                print 'Error: "%s" item got unexpected "%s" action' \
+                        % (item.name, action_name)
+                exit(1)
+
+    def run_actions(item):
+        for action_name in args:
+            action = item.get_action(action_name)
+            action()
+
+    # The agent runs several commands in the same process
+    del health_checks[:]
+
+    status = 0
+    try:
+        if len(items) == 1:
+            run_actions(items[0])
+        else:
+            durations = {}
+            def run_item(item):
+                start = time()
+                try:
+                    with log_prefix(item.name), span(item.name):
+                        run_actions(item)
+                finally:
+                    durations[item.name] = time() - start
+
+            results = run_parallel(run_item, items, options.parallel)
+            output.flush()
+
+            # Results, keep stdout for the JSON reports
+            out = sys.stderr if options.json else sys.stdout
+            width = max([ len(x.name) for x in items ])
+            print >> out
+            print >> out, '%s  %-6s  %8s' % ('Item'.ljust(width), 'Status',
+                                             'Duration')
+            for item, x, error in results:
+                line = '%s  %-6s  %7.1fs' % (item.name.ljust(width),
+                                             'FAILED' if error else 'OK',
+                                             durations[item.name])
+                if error:
+                    status = 1
+                    line = '%s  %s' % (line, error)
+                print >> out, line
+
+            # Health of the whole fleet
+            if health_checks:
+                print_health_report('fleet', health_checks, options.json)
+    finally:
+        if options.profile:
+            write_profile(options.profile)
+
+    # Close connections, unless run by the agent
+    if close:
+        for host in remote_hosts.values():
+            host.close()
+
+    exit(status)
+
+
+
+if __name__ == '__main__':
+    # Init logger
+    log_file_path = expanduser('~/.usine/usine.log')
+    logger = UsineLogger(log_file_path)
+    register_logger(logger, None)
+
+    argv = sys.argv[1:]
+    options, args = get_parser().parse_args(argv)
+    agent_path = expanduser('~/.usine/agent.sock')
+
+    # Run the agent
+    if options.daemon:
+        UsineAgent(agent_path, lambda argv: main(argv, close=False)).serve()
+        exit(0)
+
+    # Send the command to the agent, if it is running
+    if options.agent:
+        status = call_agent(agent_path, argv)
+        if status is not None:
+            exit(status)
+
+    main(argv)
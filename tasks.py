@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from threading import Condition, Thread
+from time import time
+
+# Import from itools
+from itools.log import log_info, log_error
+
+# Import from usine
+from utils import inherit_context, log_prefix, span, write_output
+
+
+"""
+A task graph: every task runs as soon as the tasks it depends on are done,
+so a deploy does not wait for a whole phase (like building every package)
+before starting the next one.
+"""
+
+
+class Task(object):
+
+    def __init__(self, name, func, deps, host):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.host = host
+        # pending, running, done, failed or skipped
+        self.state = 'pending'
+        self.error = None
+        self.duration = None
+
+
+
+class TaskGraph(object):
+
+    def __init__(self):
+        self.tasks = []
+
+
+    def add(self, name, func, deps=(), host=None):
+        """Add a task calling 'func()' once the tasks 'deps' are done, and
+        return it.  'host' is the name of the host the task works on, see
+        'run'.
+        """
+        task = Task(name, func, list(deps), host)
+        self.tasks.append(task)
+        return task
+
+
+    def get_critical_path(self, estimates):
+        """Return the duration and the tasks of the longest chain of
+        dependent tasks.  'estimates' gives the expected duration of the
+        tasks, by name, 1 second when not known.
+        """
+        # The dependencies of a task are added before it
+        paths = {}
+        for task in self.tasks:
+            duration, path = max([ paths[x] for x in task.deps ] or [(0, [])])
+            duration += estimates.get(task.name, 1.0)
+            paths[task] = (duration, path + [task])
+        if not paths:
+            return 0, []
+        return max(paths.values())
+
+
+    def print_plan(self, estimates):
+        """Print the tasks, their dependencies and the critical path.
+        """
+        width = max([ len(x.name) for x in self.tasks ] + [4])
+        lines = ['%s  %-12s  %8s  %s\n' % ('Task'.ljust(width), 'Host',
+                                          'Estimate', 'After')]
+        for task in self.tasks:
+            estimate = estimates.get(task.name)
+            estimate = '-' if estimate is None else '%.1fs' % estimate
+            deps = ', '.join([ x.name for x in task.deps ]) or '-'
+            lines.append('%s  %-12s  %8s  %s\n' % (
+                task.name.ljust(width), task.host or '-', estimate, deps))
+        duration, path = self.get_critical_path(estimates)
+        lines.append('Critical path (%.1fs): %s\n' % (
+            duration, ' > '.join([ x.name for x in path ])))
+        write_output(''.join(lines))
+
+
+    def run(self, jobs=1, limits=None):
+        """Run the tasks, every one once its dependencies are done, at most
+        'jobs' at a time, and at most 'limits[host]' at a time on a host.
+        The tasks depending on a failed task are skipped.  Return the
+        failed tasks.
+        """
+        jobs = max(1, jobs)
+        limits = dict([ (x, max(1, y)) for x, y in (limits or {}).items() ])
+        condition = Condition()
+        running = {}
+
+        @inherit_context
+        def call(task):
+            start = time()
+            try:
+                with log_prefix(task.name), span(task.name, host=task.host):
+                    task.func()
+            except (Exception, SystemExit) as error:
+                task.error = error
+                state = 'failed'
+            else:
+                state = 'done'
+            with condition:
+                task.duration = time() - start
+                task.state = state
+                running[task.host] -= 1
+                condition.notify()
+
+        def is_ready(task):
+            if task.state != 'pending':
+                return False
+            if [ x for x in task.deps if x.state != 'done' ]:
+                return False
+            limit = limits.get(task.host)
+            return limit is None or running.get(task.host, 0) < limit
+
+        with condition:
+            while True:
+                # Skip the tasks that cannot run anymore
+                for task in self.tasks:
+                    if task.state == 'pending' and [
+                        x for x in task.deps if x.state in ('failed',
+                                                            'skipped') ]:
+                        log_info('[SKIP] %s' % task.name)
+                        task.state = 'skipped'
+
+                # Start the tasks ready
+                for task in self.tasks:
+                    if sum(running.values()) >= jobs:
+                        break
+                    if is_ready(task):
+                        task.state = 'running'
+                        running[task.host] = running.get(task.host, 0) + 1
+                        thread = Thread(target=call, args=(task,))
+                        thread.daemon = True
+                        thread.start()
+
+                if not sum(running.values()):
+                    break
+                # With a timeout so KeyboardInterrupt is still delivered
+                condition.wait(0.5)
+
+        # Every task must have run or been skipped
+        pending = [ x.name for x in self.tasks if x.state == 'pending' ]
+        if pending:
+            raise EnvironmentError(
+                'tasks never started: %s' % ', '.join(pending))
+
+        failed = [ x for x in self.tasks if x.state == 'failed' ]
+        for task in failed:
+            log_error('[ERROR] %s: %s' % (task.name, task.error))
+        return failed
@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from os.path import basename
+from shutil import rmtree
+from subprocess import call
+from sys import executable
+from tempfile import mkdtemp
+from unittest import TestCase, SkipTest, main
+
+# Import from usine
+try:
+    from libusine.modules_source import find_wheel
+except ImportError:
+    find_wheel = None
+
+
+setup_py = """from setuptools import setup
+setup(name='usine-test_pkg', version='1.0.dev0', py_modules=[])
+"""
+
+
+class FindWheelTestCase(TestCase):
+
+    def setUp(self):
+        if find_wheel is None:
+            raise SkipTest('itools is not installed')
+        self.folder = mkdtemp()
+        with open('%s/setup.py' % self.folder, 'w') as file:
+            file.write(setup_py)
+        command = [executable, '-m', 'pip', 'wheel', '--quiet', '--no-deps',
+                   '--wheel-dir', 'dist', '.']
+        if call(command, cwd=self.folder):
+            rmtree(self.folder)
+            raise SkipTest('cannot build wheels here')
+
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+
+    def test_find(self):
+        wheel = find_wheel('%s/dist' % self.folder, 'usine-test_pkg',
+                           '1.0.dev0')
+        self.assertTrue(basename(wheel).startswith('usine_test_pkg-1.0.dev0-'))
+
+
+    def test_missing(self):
+        self.assertRaises(EnvironmentError, find_wheel,
+                          '%s/dist' % self.folder, 'usine-test_pkg', '2.0')
+
+
+
+if __name__ == '__main__':
+    main()
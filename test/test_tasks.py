@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from threading import Lock
+from time import sleep
+from unittest import TestCase, SkipTest, main
+
+# Import from usine
+try:
+    from libusine.tasks import TaskGraph
+except ImportError:
+    TaskGraph = None
+
+
+class TaskGraphTestCase(TestCase):
+
+    def setUp(self):
+        if TaskGraph is None:
+            raise SkipTest('itools is not installed')
+
+
+    def test_skip(self):
+        def fail():
+            raise EnvironmentError('failed')
+        done = []
+        graph = TaskGraph()
+        a = graph.add('a', fail)
+        b = graph.add('b', lambda: done.append('b'), [a])
+        c = graph.add('c', lambda: done.append('c'), [b])
+        d = graph.add('d', lambda: done.append('d'))
+        failed = graph.run(jobs=2)
+        self.assertEqual(failed, [a])
+        self.assertEqual(done, ['d'])
+        self.assertEqual([ x.state for x in (a, b, c, d) ],
+                         ['failed', 'skipped', 'skipped', 'done'])
+
+
+    def test_limits(self):
+        lock = Lock()
+        running = {'h1': 0, 'h2': 0}
+        most = {'h1': 0, 'h2': 0}
+        def work(host):
+            with lock:
+                running[host] += 1
+                most[host] = max(most[host], running[host])
+            sleep(0.05)
+            with lock:
+                running[host] -= 1
+
+        graph = TaskGraph()
+        for i in range(4):
+            graph.add('h1 %d' % i, lambda: work('h1'), host='h1')
+            graph.add('h2 %d' % i, lambda: work('h2'), host='h2')
+        self.assertEqual(graph.run(jobs=8, limits={'h1': 1}), [])
+        self.assertEqual(most['h1'], 1)
+        self.assertTrue(most['h2'] > 1)
+
+
+    def test_no_jobs(self):
+        done = []
+        graph = TaskGraph()
+        graph.add('a', lambda: done.append('a'))
+        self.assertEqual(graph.run(jobs=0), [])
+        self.assertEqual(done, ['a'])
+
+
+    def test_critical_path(self):
+        graph = TaskGraph()
+        a = graph.add('a', None)
+        b = graph.add('b', None, [a])
+        c = graph.add('c', None)
+        d = graph.add('d', None, [b, c])
+        duration, path = graph.get_critical_path({'a': 2.0, 'c': 5.0})
+        # a (2) + b (1, not known) + d (1) < c (5) + d (1)
+        self.assertEqual(duration, 6.0)
+        self.assertEqual(path, [c, d])
+        self.assertEqual(TaskGraph().get_critical_path({}), (0, []))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -16,13 +16,22 @@
 
 # Import from standard
 from _socket import gethostname
+from atexit import register
+from contextlib import contextmanager
 from datetime import datetime
-from sys import stderr
+from itertools import count
+from json import dump
+from math import ceil
+from os import rename
+from os.path import exists
+from Queue import Queue, Empty
+import sys
+from threading import Lock, Thread, current_thread, local as thread_local
+from time import localtime, strftime, time
+from traceback import print_exc
 
 # Import from itools
-from time import strftime
-
-from itools.log import log_info, Logger
+from itools.log import log_info, Logger, FATAL
 
 
 def logWrapper(func):
@@ -33,30 +42,414 @@ def logWrapper(func):
         start_dtime = datetime.now()
         log_info('Start {} ({})'.format(func_name, start_dtime))
         # Function call !
-        func(*args, **kwargs)
+        name = getattr(args[0], 'name', None) if args else None
+        name = '{} {}'.format(func_name, name) if name else func_name
+        with span(name):
+            result = func(*args, **kwargs)
         duration = datetime.now() - start_dtime
         log_info('End {} (duration : {})'.format(func_name, duration))
+        return result
+    return wrapper
+
+
+
+def format_size(size):
+    """Return the given number of bytes in a human readable form.
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size = size / 1024.0
+    return '%.1f TB' % size
+
+
+
+def get_percentile(values, percent):
+    """Return the given percentile of the values (nearest rank), or None if
+    there are not any.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+
+###########################################################################
+# Per-thread context
+###########################################################################
+context = thread_local()
+
+
+def get_log_prefix():
+    return getattr(context, 'prefix', '')
+
+
+@contextmanager
+def log_prefix(prefix):
+    """Prefix every message logged by the current thread with the given
+    string, so the output of concurrent tasks can be told apart.
+    """
+    old_prefix = get_log_prefix()
+    context.prefix = '{}[{}] '.format(old_prefix, prefix)
+    try:
+        yield
+    finally:
+        context.prefix = old_prefix
+
+
+
+def inherit_context(func):
+    """Return a function calling 'func' with the log prefix and the span of
+    the current thread, so the work it runs in other threads logs with the
+    same prefix and its spans are nested in the current one.
+    """
+    prefix = get_log_prefix()
+    parent_span = getattr(context, 'span', None)
+
+    def wrapper(*args, **kwargs):
+        context.prefix = prefix
+        context.span = parent_span
+        return func(*args, **kwargs)
     return wrapper
 
 
 
+def write_output(data):
+    """Write the output of a command to stdout, prefixing every line with
+    the log prefix of the current thread.  Only whole lines are written, so
+    the output of concurrent tasks is not mixed within a line; the start of
+    a line is kept until the rest comes (see end_output).
+    """
+    data = getattr(context, 'partial', '') + data
+    end = data.rfind('\n') + 1
+    context.partial = data[end:]
+    if end:
+        prefix = get_log_prefix()
+        data = data[:end]
+        if prefix:
+            data = ''.join([ prefix + x for x in data.splitlines(True) ])
+        output.write(sys.stdout, data)
+
+
+def end_output():
+    """Write the last line of the output of the current thread, if it
+    does not end with a new line.
+    """
+    if getattr(context, 'partial', ''):
+        write_output('\n')
+
+
+
+###########################################################################
+# Output
+###########################################################################
+hostname = gethostname()
+log_date = [None, None]
+
+def format_log_line(timestamp, message):
+    """Return the line of the log file for the given message.  Called
+    for every line, so the date is only formatted once per second.
+    """
+    second = int(timestamp)
+    if log_date[0] != second:
+        log_date[:] = [second, strftime('%Y-%m-%d %H:%M:%S', localtime(second))]
+    return '{0} {1}: {2}\n'.format(log_date[1], hostname, message)
+
+
+
+class OutputWriter(Thread):
+    """Write the log messages and the output of the commands from a
+    background thread, so the workers do not wait for the terminal or the
+    disk.  What is waiting is written at once, with one flush per stream.
+    The log file is rotated when it grows over 'max_size' bytes, keeping
+    'backups' old files (usine.log.1, ...).
+
+    If writing fails, the error is printed once to the original stderr and
+    the thread stops; from then on the callers write by themselves.
+    """
+
+    def __init__(self, max_size=10 * 1024 * 1024, backups=5):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue()
+        self.log_file = None
+        self.max_size = max_size
+        self.backups = backups
+        self.file = None
+        self.lock = Lock()
+        self.failed = False
+
+
+    def write(self, stream, data, message=None):
+        """Write the data to the given stream (sys.stdout, sys.stderr), and
+        the message to the log file.
+        """
+        if message is not None:
+            message = (time(), message)
+        item = (stream, data, message)
+        with self.lock:
+            if self.failed:
+                self.write_items([item])
+                return
+            if not self.is_alive():
+                self.start()
+            self.queue.put(item)
+
+
+    def flush(self):
+        """Wait until everything is written.
+        """
+        if self.is_alive():
+            self.queue.join()
+
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            # Take what else is waiting, to write it at once
+            while len(items) < 1000:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.write_items(items)
+            except Exception:
+                with self.lock:
+                    self.failed = True
+                    sys.__stderr__.write('usine: the output thread stopped\n')
+                    print_exc(file=sys.__stderr__)
+                    # Nobody waits for what is left
+                    while True:
+                        try:
+                            self.queue.get_nowait()
+                        except Empty:
+                            break
+                        self.queue.task_done()
+                return
+            finally:
+                for item in items:
+                    self.queue.task_done()
+
+
+    def write_items(self, items):
+        streams = []
+        chunks = {}
+        lines = []
+        for stream, data, message in items:
+            if data:
+                if stream not in chunks:
+                    streams.append(stream)
+                    chunks[stream] = []
+                chunks[stream].append(data)
+            if message:
+                lines.append(format_log_line(*message))
+
+        for stream in streams:
+            stream.write(''.join(chunks[stream]))
+            stream.flush()
+        if lines and self.log_file:
+            self.write_log(''.join(lines))
+
+
+    def write_log(self, data):
+        if self.file is None:
+            self.file = open(self.log_file, 'a')
+        self.file.write(data)
+        self.file.flush()
+        if self.file.tell() > self.max_size:
+            self.rotate()
+
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        path = self.log_file
+        for i in range(self.backups - 1, 0, -1):
+            if exists('%s.%d' % (path, i)):
+                rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+        rename(path, '%s.1' % path)
+
+
+
+output = OutputWriter()
+# Write what is left before exiting
+register(output.flush)
+
+
+
+###########################################################################
+# Timing spans
+###########################################################################
+class Tracer(object):
+    """Keep the timing spans of the current command, when enabled (see the
+    --profile option).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.lock = Lock()
+        self.ids = count()
+        self.threads = {}
+
+
+    def reset(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self.spans = []
+            self.threads = {}
+
+
+    def add(self, span):
+        with self.lock:
+            # Small thread numbers read better in the trace viewers
+            thread = current_thread().ident
+            span['thread'] = self.threads.setdefault(thread, len(self.threads))
+            self.spans.append(span)
+
+
+    def write_trace(self, path):
+        """Write the spans to the given file in the Chrome trace format,
+        to open with chrome://tracing or https://ui.perfetto.dev
+        """
+        origin = min([ x['start'] for x in self.spans ] or [0])
+        events = [
+            {'name': x['name'], 'ph': 'X', 'pid': 1, 'tid': x['thread'],
+             'ts': int((x['start'] - origin) * 1000000),
+             'dur': int(x['duration'] * 1000000),
+             'args': x['tags']}
+            for x in self.spans ]
+        with open(path, 'w') as file:
+            dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+    def get_slowest(self, size=10):
+        """Return the slowest steps, the spans without nested spans, from
+        the slowest.
+        """
+        parents = set([ x['parent'] for x in self.spans ])
+        steps = [ x for x in self.spans if x['id'] not in parents ]
+        steps.sort(key=lambda x: x['duration'], reverse=True)
+        return steps[:size]
+
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def span(name, **tags):
+    """Time the block, nested within the current span of the thread.
+    Yield the tags of the span, the block may add some (like the exit
+    status).
+    """
+    if not tracer.enabled:
+        yield tags
+        return
+
+    parent = getattr(context, 'span', None)
+    current = {'id': next(tracer.ids), 'name': name, 'tags': tags}
+    if parent is None:
+        current['parent'] = None
+        current['path'] = name
+    else:
+        current['parent'] = parent['id']
+        current['path'] = '{} > {}'.format(parent['path'], name)
+
+    context.span = current
+    current['start'] = time()
+    try:
+        yield tags
+    except BaseException as error:
+        tags['error'] = str(error)
+        raise
+    finally:
+        current['duration'] = time() - current['start']
+        context.span = parent
+        tracer.add(current)
+
+
+
+###########################################################################
+# Worker pool
+###########################################################################
+def run_parallel(func, items, jobs=1):
+    """Call 'func(item)' for every item, using at most 'jobs' threads.
+
+    Return a list of (item, result, error) tuples in the order of the
+    items, where 'error' is the exception raised (or None).  Errors do not
+    stop the other tasks.
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    @inherit_context
+    def call(index):
+        item = items[index]
+        try:
+            result = func(item)
+        except (Exception, SystemExit) as error:
+            results[index] = (item, None, error)
+        else:
+            results[index] = (item, result, None)
+
+    # Sequential
+    jobs = max(1, min(jobs, len(items)))
+    if jobs == 1:
+        for index in range(len(items)):
+            call(index)
+        return results
+
+    # Concurrent
+    queue = Queue()
+    for index in range(len(items)):
+        queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Empty:
+                return
+            call(index)
+
+    threads = [ Thread(target=worker) for x in range(jobs) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    # Join with a timeout so KeyboardInterrupt is still delivered
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return results
+
+
+
 class UsineLogger(Logger):
     """
     Override default logger to always write to stderr !
+    The messages are written by the background writer, see OutputWriter.
     """
 
+    def __init__(self, log_file=None):
+        super(UsineLogger, self).__init__(log_file)
+        output.log_file = log_file
+
+
     def log(self, domain, level, message):
         """Override to always write to stdout"""
+        message = get_log_prefix() + message
         # Add carriage return for print message
-        print_msg = message + '\n'
-        stderr.write(print_msg)
-        # Override to always write to stdout !
-        super(UsineLogger, self).log(domain, level, message)
+        output.write(sys.stderr, message + '\n', message)
+        if level == FATAL:
+            output.flush()
+            sys.exit(1)
 
 
     def format(self, domain, level, message):
         """Override to not log traceback"""
-        date = strftime('%Y-%m-%d %H:%M:%S')
-        host = gethostname()
-        header = '{0} {1}: {2}\n'
-        return header.format(date, host, message)
+        return format_log_line(time(), message)